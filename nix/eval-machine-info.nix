@@ -279,7 +279,10 @@ rec {
             optionalAttrs (v.config.deployment.targetEnv == "virtualbox") (cfg
               // { disks = mapAttrs (n: v: v //
                 { baseImage = if isDerivation v.baseImage then "drv" else toString v.baseImage; }) cfg.disks; });
-          libvirtd = optionalAttrs (v.config.deployment.targetEnv == "libvirtd") v.config.deployment.libvirtd;
+          # Paths are converted to strings so that the JSON output
+          # doesn't copy them to the Nix store.
+          libvirtd = optionalAttrs (v.config.deployment.targetEnv == "libvirtd") (v.config.deployment.libvirtd
+            // { imageDir = toString v.config.deployment.libvirtd.imageDir; });
           publicIPv4 = v.config.networking.publicIPv4;
         }
       );
@@ -321,6 +324,47 @@ rec {
 
   };
 
+  # Like ‘info’, but only for the machines and resources in ‘names’
+  # (or all except those in ‘exclude’), and the resources they refer
+  # to, directly or by name.  Other machines are not evaluated.
+  # ‘names’ lists the names of all machines and resources, so that
+  # the caller can tell unevaluated resources from deleted ones.
+  selectedInfo = { names ? null, exclude ? [] }:
+    let
+      resources' = removeAttrs resources [ "machines" ];
+
+      allNames = attrNames nodes ++ concatMap attrNames (attrValues resources');
+
+      known = name: hasAttr name knownNames;
+      knownNames = builtins.listToAttrs (map (n: nameValuePair n true) allNames);
+
+      valueOf = name:
+        if hasAttr name nodes then builtins.getAttr name info.machines
+        else builtins.getAttr name (findFirst (hasAttr name) {} (attrValues resources'));
+
+      # Resource values carry their name in ‘_name’.  Strings may
+      # refer to resources by name, so they are included as well.
+      referencedNames = v:
+        if builtins.isFunction v || isDerivation v then []
+        else if isAttrs v then (if v ? _name then [ v._name ] else concatMap referencedNames (attrValues v))
+        else if builtins.isList v then concatMap referencedNames v
+        else if builtins.isString v then [ v ]
+        else [];
+
+      closure = map (x: x.key) (builtins.genericClosure {
+        startSet = map (key: { inherit key; })
+          (filter (n: known n && !(elem n exclude)) (if names == null then allNames else names));
+        operator = { key }: map (key: { inherit key; }) (filter known (referencedNames (valueOf key)));
+      });
+
+      selected = builtins.listToAttrs (map (n: nameValuePair n true) closure);
+    in {
+      inherit (info) network;
+      machines = filterAttrs (n: v: hasAttr n selected) info.machines;
+      resources = mapAttrs (type: filterAttrs (n: v: hasAttr n selected)) resources';
+      names = allNames;
+    };
+
   # Phase 2: build complete machine configurations.
   machines = { names }:
     let nodes' = filterAttrs (n: v: elem n names) nodes; in
@@ -333,6 +377,39 @@ rec {
         '') nodes'))}
       '';
 
+  # The values of configuration options of the machines whose names
+  # match a pattern, for ‘nixops show-options’.  Each query has a
+  # pattern ‘machine’, which may contain the wildcards ‘*’ and ‘?’, and
+  # an option ‘path’.  Machines that don't have the option are
+  # returned without a value.
+  optionValues = { queries }:
+    let
+      globMatch = pattern: name:
+        let
+          go = ps: cs:
+            if ps == [] then cs == []
+            else if head ps == "*" then go (tail ps) cs || (cs != [] && go ps (tail cs))
+            else cs != [] && (head ps == "?" || head ps == head cs) && go (tail ps) (tail cs);
+        in go (stringToCharacters pattern) (stringToCharacters name);
+    in
+      concatMap (q:
+        map (machine:
+          let config = nodes."${machine}".config; in
+          { inherit machine; inherit (q) option; }
+          // optionalAttrs (hasAttrByPath q.path config) { value = getAttrFromPath q.path config; })
+        (filter (globMatch q.machine) (attrNames nodes)))
+      queries;
+
+  # The derivations of the machine configurations, so that they can
+  # be built separately (see ‘nixops deploy --pipeline’).  This must
+  # be evaluated with ‘--read-write-mode’.
+  machineDrvs = { names }:
+    let drv = machines { inherit names; }; in
+    { machines = { inherit (drv) drvPath outPath; };
+      toplevels = mapAttrs (n: v: v.config.system.build.toplevel.drvPath)
+        (filterAttrs (n: v: elem n names) nodes);
+    };
+
 
   # Function needed to calculate the nixops arguments. This should work even when arguments
   # are not set yet, so we fake arguments to be able to evaluate the require attribute of
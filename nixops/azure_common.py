@@ -9,6 +9,7 @@ import requests
 
 from nixops.util import attr_property, check_wait
 import nixops.resources
+import nixops.rate_limit
 
 from azure import *
 
@@ -282,29 +283,42 @@ class ResourceState(nixops.resources.ResourceState):
                 self.tokens[token_id] = token
         return SubscriptionCloudCredentials(self.subscription_id, token['accessToken'])
 
+    def rate_limited(self, client):
+        """Make the calls through the management client ‘client’ wait
+        for the shared rate limit of the subscription."""
+        return nixops.rate_limit.RateLimited(
+            client, nixops.rate_limit.get_bucket("azure", None, (self.subscription_id, self.user)))
+
+    def rate_limited_storage(self, service, storage_name):
+        """Make the calls through the storage service client ‘service’
+        wait for the shared rate limit of the storage account."""
+        return nixops.rate_limit.RateLimited(
+            service, nixops.rate_limit.get_bucket("azure-storage", None, storage_name))
+
     def rmc(self):
         if not self._rmc:
-            self._rmc = ResourceManagementClient(self.get_mgmt_credentials())
+            self._rmc = self.rate_limited(ResourceManagementClient(self.get_mgmt_credentials()))
         return self._rmc
 
     def cmc(self):
         if not self._cmc:
             self.rmc().providers.register('Microsoft.Compute')
-            self._cmc = ComputeManagementClient(self.get_mgmt_credentials())
-            self._cmc.long_running_operation_initial_timeout = 3
-            self._cmc.long_running_operation_retry_timeout = 5
+            cmc = ComputeManagementClient(self.get_mgmt_credentials())
+            cmc.long_running_operation_initial_timeout = 3
+            cmc.long_running_operation_retry_timeout = 5
+            self._cmc = self.rate_limited(cmc)
         return self._cmc
 
     def nrpc(self):
         if not self._nrpc:
             self.rmc().providers.register('Microsoft.Network')
-            self._nrpc = NetworkResourceProviderClient(self.get_mgmt_credentials())
+            self._nrpc = self.rate_limited(NetworkResourceProviderClient(self.get_mgmt_credentials()))
         return self._nrpc
 
     def smc(self):
         if not self._smc:
             self.rmc().providers.register('Microsoft.Storage')
-            self._smc = StorageManagementClient(self.get_mgmt_credentials())
+            self._smc = self.rate_limited(StorageManagementClient(self.get_mgmt_credentials()))
         return self._smc
 
 
@@ -507,22 +521,22 @@ class StorageResourceState(ResourceState):
 
     def bs(self):
         if not self._bs:
-            self._bs = BlobService(self.get_storage_name(), self.get_key())
+            self._bs = self.rate_limited_storage(BlobService(self.get_storage_name(), self.get_key()), self.get_storage_name())
         return self._bs
 
     def qs(self):
         if not self._qs:
-            self._qs = QueueService(self.get_storage_name(), self.get_key())
+            self._qs = self.rate_limited_storage(QueueService(self.get_storage_name(), self.get_key()), self.get_storage_name())
         return self._qs
 
     def ts(self):
         if not self._ts:
-            self._ts = TableService(self.get_storage_name(), self.get_key())
+            self._ts = self.rate_limited_storage(TableService(self.get_storage_name(), self.get_key()), self.get_storage_name())
         return self._ts
 
     def fs(self):
         if not self._fs:
-            self._fs = FileService(self.get_storage_name(), self.get_key())
+            self._fs = self.rate_limited_storage(FileService(self.get_storage_name(), self.get_key()), self.get_storage_name())
         return self._fs
 
 
@@ -13,23 +13,22 @@ class MachineDefinition(nixops.resources.ResourceDefinition):
 
     def __init__(self, xml, config={}):
         nixops.resources.ResourceDefinition.__init__(self, xml, config)
-        self.encrypted_links_to = set([e.get("value") for e in xml.findall("attrs/attr[@name='encryptedLinksTo']/list/string")])
-        self.store_keys_on_machine = xml.find("attrs/attr[@name='storeKeysOnMachine']/bool").get("value") == "true"
-        self.ssh_port = int(xml.find("attrs/attr[@name='targetPort']/int").get("value"))
-        self.always_activate = xml.find("attrs/attr[@name='alwaysActivate']/bool").get("value") == "true"
-        self.owners = [e.get("value") for e in xml.findall("attrs/attr[@name='owners']/list/string")]
-        self.has_fast_connection = xml.find("attrs/attr[@name='hasFastConnection']/bool").get("value") == "true"
+        if not config:
+            # Backward compatibility with definitions that don't pass
+            # the evaluated attributes.
+            config = nixops.util.xml_expr_to_python(xml.find("*"))
+        self.encrypted_links_to = set(config["encryptedLinksTo"])
+        self.store_keys_on_machine = config["storeKeysOnMachine"]
+        self.ssh_port = config["targetPort"]
+        self.always_activate = config["alwaysActivate"]
+        self.owners = config["owners"]
+        self.has_fast_connection = config["hasFastConnection"]
 
         def _extract_key_options(x):
-            opts = {}
-            for key in ('text', 'user', 'group', 'permissions'):
-                elem = x.find("attrs/attr[@name='{0}']/string".format(key))
-                if elem is not None:
-                    opts[key] = elem.get("value")
-            return opts
+            return {key: x[key] for key in ('text', 'user', 'group', 'permissions')
+                    if isinstance(x.get(key), basestring)}
 
-        self.keys = {k.get("name"): _extract_key_options(k) for k in
-                     xml.findall("attrs/attr[@name='keys']/attrs/attr")}
+        self.keys = {k: _extract_key_options(v) for k, v in config["keys"].iteritems()}
 
 
 class MachineState(nixops.resources.ResourceState):
@@ -44,6 +43,10 @@ class MachineState(nixops.resources.ResourceState):
     keys = nixops.util.attr_property("keys", {}, 'json')
     owners = nixops.util.attr_property("owners", [], 'json')
 
+    # The ‘deployment.encryptedLinksTo’ option of the machine at the
+    # last evaluation, or None if it hasn't been recorded yet.
+    encrypted_links_to = nixops.util.attr_property("encryptedLinksTo", None, 'json')
+
     # Nix store path of the last global configuration deployed to this
     # machine.  Used to check whether this machine is up to date with
     # respect to the global configuration.
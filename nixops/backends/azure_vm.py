@@ -259,7 +259,7 @@ class AzureState(MachineState, ResourceState):
         if not self._bs:
             storage_resource = next((r for r in self.depl.resources.values()
                                        if getattr(r, 'storage_name', None) == self.storage), None)
-            self._bs = BlobService(self.storage, storage_resource.access_key)
+            self._bs = self.rate_limited_storage(BlobService(self.storage, storage_resource.access_key), self.storage)
         return self._bs
 
     # delete_vhd = None: ask the user
@@ -14,9 +14,7 @@ class ContainerDefinition(MachineDefinition):
 
     def __init__(self, xml, config):
         MachineDefinition.__init__(self, xml, config)
-        x = xml.find("attrs/attr[@name='container']/attrs")
-        assert x is not None
-        self.host = x.find("attr[@name='host']/string").get("value")
+        self.host = config["container"]["host"]
 
 class ContainerState(MachineState):
     """State of a NixOS container."""
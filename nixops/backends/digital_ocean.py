@@ -25,6 +25,7 @@ from nixops.backends import MachineDefinition, MachineState
 from nixops.nix_expr import Function, RawValue
 import nixops.util
 import nixops.known_hosts
+import nixops.rate_limit
 import socket
 import digitalocean
 
@@ -114,10 +115,16 @@ class DigitalOceanState(MachineState):
     def get_auth_token(self):
         return os.environ.get('DIGITAL_OCEAN_AUTH_TOKEN', self.auth_token)
 
+    def rate_limited(self, obj):
+        """Make the API requests of the DigitalOcean object ‘obj’
+        subject to the shared limits of the auth token."""
+        bucket = nixops.rate_limit.get_bucket("digitalocean", None, self.get_auth_token())
+        return nixops.rate_limit.limit_method(obj, "get_data", bucket)
+
     def destroy(self, wipe=False):
         self.log("destroying droplet {}".format(self.droplet_id))
         try:
-            droplet = digitalocean.Droplet(id=self.droplet_id, token=self.get_auth_token())
+            droplet = self.rate_limited(digitalocean.Droplet(id=self.droplet_id, token=self.get_auth_token()))
             droplet.destroy()
         except digitalocean.baseapi.NotFoundError:
             self.log("droplet not found - assuming it's been destroyed already")
@@ -134,8 +141,8 @@ class DigitalOceanState(MachineState):
         if self.droplet_id is not None:
             return
 
-        self.manager = digitalocean.Manager(token=self.get_auth_token())
-        droplet = digitalocean.Droplet(
+        self.manager = self.rate_limited(digitalocean.Manager(token=self.get_auth_token()))
+        droplet = self.rate_limited(digitalocean.Droplet(
             token=self.get_auth_token(),
             name=self.name,
             region=defn.region,
@@ -143,7 +150,7 @@ class DigitalOceanState(MachineState):
             ssh_keys=[ssh_key.public_key],
             image='ubuntu-16-04-x64', # only for lustration
             size_slug=defn.size,
-        )
+        ))
 
         self.log_start("creating droplet ...")
         droplet.create()
@@ -152,7 +159,7 @@ class DigitalOceanState(MachineState):
         while status == 'in-progress':
             actions = droplet.get_actions()
             for action in actions:
-                action.load()
+                self.rate_limited(action).load()
                 if action.status != 'in-progress':
                     status = action.status
             time.sleep(1)
@@ -265,7 +265,8 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
         # Get the secret access key from the environment or from ~/.ec2-keys.
         (access_key_id, secret_access_key) = nixops.ec2_utils.fetch_aws_secret_key(self.route53_access_key_id)
 
-        self._conn_route53 = boto.connect_route53(access_key_id, secret_access_key)
+        self._conn_route53 = nixops.ec2_utils.rate_limited(
+            boto.connect_route53(access_key_id, secret_access_key), "route53", None, access_key_id)
 
 
     def _get_spot_instance_request_by_id(self, request_id, allow_missing=False):
@@ -482,17 +483,46 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
 
     def create_after(self, resources, defn):
         # EC2 instances can require key pairs, IAM roles, security
-        # groups, EBS volumes and elastic IPs.  FIXME: only depend on
-        # the specific key pair / role needed for this instance.
-        return {r for r in resources if
-                isinstance(r, nixops.resources.ec2_keypair.EC2KeyPairState) or
-                isinstance(r, nixops.resources.iam_role.IAMRoleState) or
-                isinstance(r, nixops.resources.ec2_security_group.EC2SecurityGroupState) or
-                isinstance(r, nixops.resources.ec2_placement_group.EC2PlacementGroupState) or
-                isinstance(r, nixops.resources.ebs_volume.EBSVolumeState) or
-                isinstance(r, nixops.resources.elastic_ip.ElasticIPState) or
-                isinstance(r, nixops.resources.elastic_file_system.ElasticFileSystemState) or
-                isinstance(r, nixops.resources.elastic_file_system_mount_target.ElasticFileSystemMountTargetState)}
+        # groups, placement groups, EBS volumes and elastic IPs.  Only
+        # depend on the ones referenced by this instance, either by
+        # name or (for EBS volumes and elastic IPs) as ‘res-<name>’.
+        # EFS file systems are referenced from the NixOS configuration,
+        # so we can't tell which ones are needed.  When destroying,
+        # there is no definition to go by.
+        if defn is None:
+            return {r for r in resources if
+                    isinstance(r, nixops.resources.ec2_keypair.EC2KeyPairState) or
+                    isinstance(r, nixops.resources.iam_role.IAMRoleState) or
+                    isinstance(r, nixops.resources.ec2_security_group.EC2SecurityGroupState) or
+                    isinstance(r, nixops.resources.ec2_placement_group.EC2PlacementGroupState) or
+                    isinstance(r, nixops.resources.ebs_volume.EBSVolumeState) or
+                    isinstance(r, nixops.resources.elastic_ip.ElasticIPState) or
+                    isinstance(r, nixops.resources.elastic_file_system.ElasticFileSystemState) or
+                    isinstance(r, nixops.resources.elastic_file_system_mount_target.ElasticFileSystemMountTargetState)}
+
+        names = {defn.key_pair, defn.placement_group, defn.instance_profile}
+        names.update(defn.security_groups, defn.security_group_ids)
+        names.discard(None)
+        names.discard("")
+        res_names = {defn.elastic_ipv4} | {v['disk'] for v in defn.block_device_mapping.itervalues()}
+
+        def referenced(r):
+            r_defn = self.depl.definitions.get(r.name)
+            if isinstance(r, nixops.resources.ec2_keypair.EC2KeyPairState):
+                return getattr(r_defn, 'keypair_name', None) in names
+            if isinstance(r, nixops.resources.iam_role.IAMRoleState):
+                return getattr(r_defn, 'role_name', None) in names
+            if isinstance(r, nixops.resources.ec2_security_group.EC2SecurityGroupState):
+                return getattr(r_defn, 'security_group_name', None) in names
+            if isinstance(r, nixops.resources.ec2_placement_group.EC2PlacementGroupState):
+                return getattr(r_defn, 'placement_group_name', None) in names
+            if isinstance(r, nixops.resources.ebs_volume.EBSVolumeState) or \
+               isinstance(r, nixops.resources.elastic_ip.ElasticIPState):
+                return "res-" + r.name in res_names
+            return isinstance(r, nixops.resources.elastic_file_system.ElasticFileSystemState) or \
+                isinstance(r, nixops.resources.elastic_file_system_mount_target.ElasticFileSystemMountTargetState)
+
+        return {r for r in resources if referenced(r)}
 
 
     def attach_volume(self, device, volume_id):
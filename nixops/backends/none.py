@@ -16,10 +16,8 @@ class NoneDefinition(MachineDefinition):
 
     def __init__(self, xml, config):
         MachineDefinition.__init__(self, xml, config)
-        self._target_host = xml.find("attrs/attr[@name='targetHost']/string").get("value")
-
-        public_ipv4 = xml.find("attrs/attr[@name='publicIPv4']/string")
-        self._public_ipv4 = None if public_ipv4 is None else public_ipv4.get("value")
+        self._target_host = config["targetHost"]
+        self._public_ipv4 = config["publicIPv4"]
 
 class NoneState(MachineState):
     """State of a trivial machine."""
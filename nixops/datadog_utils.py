@@ -2,6 +2,7 @@
 
 from datadog import initialize, api
 import os
+import nixops.rate_limit
 
 def initializeDatadog(api_key, app_key):
     if not api_key: api_key = os.environ.get('DATADOG_API_KEY')
@@ -10,7 +11,7 @@ def initializeDatadog(api_key, app_key):
         raise Exception("please set the datadog apiKey and appKey options (or the environment variables DATADOG_API_KEY and DATADOG_APP_KEY)")
     options = {'api_key': api_key, 'app_key': app_key}
     initialize(**options)
-    return (api, options)
+    return (nixops.rate_limit.RateLimited(api, nixops.rate_limit.get_bucket("datadog", None, api_key)), options)
 
 def get_template_variables(defn):
     variables = defn.config['templateVariables']
@@ -10,13 +10,16 @@ import shutil
 import threading
 import exceptions
 import errno
+import hashlib
+import contextlib
+import StringIO
 from collections import defaultdict
-from xml.etree import ElementTree
 import nixops.statefile
 import nixops.backends
 import nixops.logger
 import nixops.parallel
-from nixops.nix_expr import RawValue, Function, Call, nixmerge, py2nix
+import nixops.eval_cache
+from nixops.nix_expr import RawValue, MultiLineRawValue, Function, Call, NixMergeBuilder, py2nix, py2nix_attrs, py2nix_let
 import re
 from datetime import datetime, timedelta
 import getpass
@@ -50,6 +53,14 @@ class Deployment(object):
     configs_path = nixops.util.attr_property("configsPath", None)
     rollback_enabled = nixops.util.attr_property("rollbackEnabled", False)
 
+    # Fingerprint of the last successful deployment (see
+    # _get_deploy_fingerprint()).
+    deploy_fingerprint = nixops.util.attr_property("deployFingerprint", None)
+
+    # Average time in seconds taken to create and destroy resources of
+    # each type, as {"create": {type: secs}, "destroy": {type: secs}}.
+    resource_durations = nixops.util.attr_property("resourceDurations", {}, 'json')
+
     def __init__(self, statefile, uuid, log_file=sys.stderr):
         self._statefile = statefile
         self._db = statefile._db
@@ -62,6 +73,22 @@ class Deployment(object):
         self.nixos_version_suffix = None
         self._tempdir = None
 
+        # Whether to batch resource attribute writes during deployment
+        # (see AttrJournal).
+        self.batch_attr_writes = False
+
+        # Whether to reuse the output of previous evaluations of the
+        # same expressions (see nixops.eval_cache).
+        self.use_eval_cache = False
+
+        # Durations of the phases of the last deployment, as a list of
+        # (phase, seconds) pairs (shown by ‘nixops deploy --debug’).
+        self.phase_times = []
+
+        # Parts of the physical spec, to avoid regenerating it from
+        # scratch (see write_physical_spec()).
+        self._physical_cache = PhysicalSpecCache()
+
         self.logger = nixops.logger.Logger(log_file)
 
         self._lock_file_path = None
@@ -74,6 +101,7 @@ class Deployment(object):
 
         self.resources = {}
         with self._db:
+            self._load_attrs()
             c = self._db.cursor()
             c.execute("select id, name, type from Resources where deployment = ?", (self.uuid,))
             for (id, name, type) in c.fetchall():
@@ -82,6 +110,7 @@ class Deployment(object):
         self.logger.update_log_prefixes()
 
         self.definitions = None
+        self.defined_names = None
 
 
     @property
@@ -121,6 +150,60 @@ class Deployment(object):
         return res
 
 
+    def _load_attrs(self):
+        """Load the attributes of this deployment and of all its
+        resources from the state file into memory, using a single
+        query.  Attribute reads are then served from memory, while
+        writes go through to the state file."""
+        attrs = {}
+        resource_attrs = defaultdict(dict)
+        with self._db:
+            c = self._db.cursor()
+            c.execute("select null, name, value from DeploymentAttrs where deployment = ? " +
+                      "union all " +
+                      "select a.machine, a.name, a.value from ResourceAttrs a join Resources r on r.id = a.machine " +
+                      "where r.deployment = ?", (self.uuid, self.uuid))
+            for (id, name, value) in c.fetchall():
+                if id is None:
+                    attrs[name] = value
+                else:
+                    resource_attrs[id][name] = value
+            # Writes collected by attribute journals (see AttrJournal)
+            # are not in the state file yet, so keep them visible.
+            for r in self.resources.itervalues():
+                for name, value in (r._attr_journal or {}).items():
+                    if value == None:
+                        resource_attrs[r.id].pop(name, None)
+                    else:
+                        resource_attrs[r.id][name] = nixops.util.db_text(value)
+            self._attrs = attrs
+            self._resource_attrs = resource_attrs
+            self._attrs_rollbacks = self._db.rollbacks
+
+
+    def _get_cached_attrs(self, id=None):
+        """Return the cached attributes of the deployment (if ‘id’ is
+        None) or of the resource with the given ID."""
+        # A rolled back transaction may have undone writes that are
+        # already in the cache, so reload it in that case.
+        if self._attrs_rollbacks != self._db.rollbacks:
+            nixops.util.attr_cache_stats.miss()
+            self._load_attrs()
+        return self._attrs if id is None else self._resource_attrs[id]
+
+
+    def _get_cached_attr(self, name, id=None):
+        """Return the cached value of attribute ‘name’ of the
+        deployment (if ‘id’ is None) or of the resource with the given
+        ID, or ‘undefined’ if it is not set."""
+        value = self._get_cached_attrs(id).get(name, nixops.util.undefined)
+        if value is nixops.util.undefined:
+            nixops.util.attr_cache_stats.miss()
+        else:
+            nixops.util.attr_cache_stats.hit()
+        return value
+
+
     def _set_attrs(self, attrs):
         """Update deployment attributes in the state file."""
         with self._db:
@@ -128,9 +211,13 @@ class Deployment(object):
             for n, v in attrs.iteritems():
                 if v == None:
                     c.execute("delete from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, n))
+                    self._attrs.pop(n, None)
                 else:
                     c.execute("insert or replace into DeploymentAttrs(deployment, name, value) values (?, ?, ?)",
                               (self.uuid, n, v))
+                    self._attrs[n] = nixops.util.db_text(v)
+            if "name" in attrs:
+                self._statefile._deployment_renamed(self.uuid, attrs["name"])
 
 
     def _set_attr(self, name, value):
@@ -142,16 +229,20 @@ class Deployment(object):
         """Delete a deployment attribute from the state file."""
         with self._db:
             self._db.execute("delete from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, name))
+            self._attrs.pop(name, None)
+            if name == "name":
+                self._statefile._deployment_renamed(self.uuid, None)
 
 
     def _get_attr(self, name, default=nixops.util.undefined):
         """Get a deployment attribute from the state file."""
-        with self._db:
-            c = self._db.cursor()
-            c.execute("select value from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, name))
-            row = c.fetchone()
-            if row != None: return row[0]
-            return nixops.util.undefined
+        return self._get_cached_attr(name)
+
+
+    def _journal_attrs(self, resources):
+        """Return a context manager that batches the attribute writes
+        of ‘resources’ if ‘batch_attr_writes’ is enabled."""
+        return AttrJournal(self, resources if self.batch_attr_writes else [])
 
 
     def _create_resource(self, name, type):
@@ -162,6 +253,7 @@ class Deployment(object):
         c.execute("insert into Resources(deployment, name, type) values (?, ?, ?)",
                   (self.uuid, name, type))
         id = c.lastrowid
+        self._resource_attrs[id] = {}
         r = _create_state(self, type, name, id)
         self.resources[name] = r
         return r
@@ -189,13 +281,12 @@ class Deployment(object):
 
 
     def clone(self):
-        with self._db:
-            new = self._statefile.create_deployment()
-            self._db.execute("insert into DeploymentAttrs (deployment, name, value) " +
-                             "select ?, name, value from DeploymentAttrs where deployment = ?",
-                             (new.uuid, self.uuid))
+        # In a sharded state file, the clone gets a shard of its own.
+        new = (self._statefile.catalog or self._statefile).create_deployment()
+        with new._db:
+            new._set_attrs(dict(self._get_cached_attrs()))
             new.configs_path = None
-            return new
+        return new
 
 
     def _get_deployment_lock(self):
@@ -227,6 +318,7 @@ class Deployment(object):
         del self.resources[m.name]
         with self._db:
             self._db.execute("delete from Resources where deployment = ? and id = ?", (self.uuid, m.id))
+            self._resource_attrs.pop(m.id, None)
 
 
     def delete(self, force=False):
@@ -244,6 +336,8 @@ class Deployment(object):
             # Delete the deployment from the database.
             self._db.execute("delete from Deployments where uuid = ?", (self.uuid,))
 
+        self._statefile._deployment_deleted(self.uuid)
+
 
     def _nix_path_flags(self):
         flags = list(itertools.chain(*[["-I", x] for x in (self.extra_nix_path + self.nix_path)])) + self.extra_nix_flags
@@ -295,7 +389,7 @@ class Deployment(object):
                 + self._eval_flags(self.nix_exprs) +
                 ["--eval-only", "--json", "--strict",
                  "-A", "nixopsArguments"], stderr=self.logger.log_file)
-            if debug: print >> sys.stderr, "JSON output of nix-instantiate:\n" + xml
+            if debug: print >> sys.stderr, "JSON output of nix-instantiate:\n" + out
             return json.loads(out)
         except OSError as e:
             raise Exception("unable to run ‘nix-instantiate’: {0}".format(e))
@@ -303,51 +397,61 @@ class Deployment(object):
             raise NixEvalError
 
 
-    def evaluate(self):
-        """Evaluate the Nix expressions belonging to this deployment into a deployment specification."""
+    def evaluate(self, include=[], exclude=[]):
+        """Evaluate the Nix expressions belonging to this deployment into a deployment specification.
+        If ‘include’ or ‘exclude’ is given, only the selected machines and resources, and the
+        resources they refer to, are evaluated; ‘defined_names’ then contains the names of
+        all machines and resources, including those that were not evaluated."""
 
         self.definitions = {}
 
-        try:
-            # FIXME: use --json
-            xml = subprocess.check_output(
-                ["nix-instantiate"]
+        if include or exclude:
+            selection = ["-A", "selectedInfo", "--arg", "exclude", py2nix(exclude, inline=True)]
+            if include: selection += ["--arg", "names", py2nix(include, inline=True)]
+        else:
+            selection = ["-A", "info"]
+
+        argv = (["nix-instantiate"]
                 + self.extra_nix_eval_flags
                 + self._eval_flags(self.nix_exprs) +
-                ["--eval-only", "--xml", "--strict",
-                 "--arg", "checkConfigurationOptions", "false",
-                 "-A", "info"], stderr=self.logger.log_file)
-            if debug: print >> sys.stderr, "XML output of nix-instantiate:\n" + xml
-        except OSError as e:
-            raise Exception("unable to run ‘nix-instantiate’: {0}".format(e))
-        except subprocess.CalledProcessError:
-            raise NixEvalError
+                ["--eval-only", "--json", "--strict",
+                 "--arg", "checkConfigurationOptions", "false"]
+                + selection)
 
-        tree = ElementTree.fromstring(xml)
+        key = None
+        if self.use_eval_cache:
+            key = nixops.eval_cache.get_key(argv, self.nix_exprs, self.extra_nix_path + self.nix_path, self.expr_path)
+        out = nixops.eval_cache.get(key) if key else None
 
-        # Convert the XML to a more Pythonic representation. This is
-        # in fact the same as what json.loads() on the output of
-        # "nix-instantiate --json" would yield.
-        config = nixops.util.xml_expr_to_python(tree.find("*"))
+        if out is not None:
+            if debug: print >> sys.stderr, "using cached evaluation ‘{0}’".format(key)
+        else:
+            try:
+                out = subprocess.check_output(argv, stderr=self.logger.log_file)
+                if debug: print >> sys.stderr, "JSON output of nix-instantiate:\n" + out
+            except OSError as e:
+                raise Exception("unable to run ‘nix-instantiate’: {0}".format(e))
+            except subprocess.CalledProcessError:
+                raise NixEvalError
+            if key: nixops.eval_cache.put(key, out)
+
+        config = json.loads(out)
 
         # Extract global deployment attributes.
-        self.description = config["network"].get("description", self.default_description)
-        self.rollback_enabled = config["network"].get("enableRollback", False)
+        if not self._statefile.read_only:
+            self.description = config["network"].get("description", self.default_description)
+            self.rollback_enabled = config["network"].get("enableRollback", False)
 
         # Extract machine information.
-        for x in tree.findall("attrs/attr[@name='machines']/attrs/attr"):
-            name = x.get("name")
-            cfg = config["machines"][name]
-            defn = _create_definition(x, cfg, cfg["targetEnv"])
-            self.definitions[name] = defn
+        for name, cfg in config["machines"].iteritems():
+            self.definitions[name] = _create_definition(name, cfg, cfg["targetEnv"])
 
         # Extract info about other kinds of resources.
-        for x in tree.findall("attrs/attr[@name='resources']/attrs/attr"):
-            res_type = x.get("name")
-            for y in x.findall("attrs/attr"):
-                name = y.get("name")
-                defn = _create_definition(y, config["resources"][res_type][name], res_type)
-                self.definitions[name] = defn
+        for res_type, resources in config["resources"].iteritems():
+            for name, cfg in resources.iteritems():
+                self.definitions[name] = _create_definition(name, cfg, res_type)
+
+        self.defined_names = set(config.get("names", self.definitions.keys()))
 
 
     def evaluate_option_value(self, machine_name, option_name, xml=False, include_physical=False):
@@ -357,7 +461,7 @@ class Deployment(object):
         if include_physical:
             phys_expr = self.tempdir + "/physical.nix"
             with open(phys_expr, 'w') as f:
-                f.write(self.get_physical_spec())
+                self.write_physical_spec(f)
             exprs.append(phys_expr)
 
         try:
@@ -374,6 +478,47 @@ class Deployment(object):
             raise NixEvalError
 
 
+    def evaluate_option_values(self, paths, include_physical=False):
+        """Evaluate options of several machines in the deployment
+        specification in a single evaluation.  ‘paths’ is a list of
+        ‘machine.option’ paths, where ‘machine’ may contain the
+        wildcards ‘*’ and ‘?’.  Return a dictionary mapping the names
+        of the matching machines to dictionaries mapping options to
+        their values.  Options that a machine doesn't have are
+        omitted."""
+
+        queries = []
+        for path in paths:
+            machine, option, attrs = _split_option_path(path)
+            queries.append({'machine': machine, 'option': option, 'path': attrs})
+
+        exprs = self.nix_exprs
+        if include_physical:
+            phys_expr = self.tempdir + "/physical.nix"
+            with open(phys_expr, 'w') as f:
+                self.write_physical_spec(f)
+            exprs = exprs + [phys_expr]
+
+        try:
+            out = subprocess.check_output(
+                ["nix-instantiate"]
+                + self.extra_nix_eval_flags
+                + self._eval_flags(exprs) +
+                ["--eval-only", "--json", "--strict",
+                 "--arg", "checkConfigurationOptions", "false",
+                 "--arg", "queries", py2nix(queries, inline=True),
+                 "-A", "optionValues"],
+                stderr=self.logger.log_file)
+        except subprocess.CalledProcessError:
+            raise NixEvalError
+
+        res = {}
+        for item in json.loads(out):
+            values = res.setdefault(item["machine"], {})
+            if "value" in item: values[item["option"]] = item["value"]
+        return res
+
+
     def get_arguments(self):
         try:
             return self.evaluate_args()
@@ -383,6 +528,13 @@ class Deployment(object):
 
     def get_physical_spec(self):
         """Compute the contents of the Nix expression specifying the computed physical deployment attributes"""
+        out = StringIO.StringIO()
+        self.write_physical_spec(out)
+        return out.getvalue()
+
+
+    def write_physical_spec(self, f):
+        """Write the Nix expression specifying the computed physical deployment attributes to ‘f’."""
 
         active_machines = self.active
         active_resources = self.active_resources
@@ -406,26 +558,37 @@ class Deployment(object):
         # lookups.
         hosts = defaultdict(lambda: defaultdict(list))
 
+        # The address of each resource, as seen by most machines, is
+        # emitted only once, in the ‘hosts’ binding of the generated
+        # expression.  Machines only get the addresses that differ
+        # from it (see ‘extraHostsFor’ below), so that the size of the
+        # expression is linear in the size of the network in the
+        # common case.
+        shared_hosts, host_overrides = self._physical_cache.update_hosts(
+            active_machines, active_resources)
+
         def index_to_private_ip(index):
             n = 105 + index / 256
             assert n <= 255
             return "192.168.{0}.{1}".format(n, index % 256)
 
+        # Machines that were not evaluated (see evaluate()) are not
+        # built, but their encrypted links affect other machines, so
+        # use the links recorded in the state file.
+        def encrypted_links_to(m):
+            defn = self.definitions.get(m.name)
+            return defn.encrypted_links_to if defn else set(m.encrypted_links_to or [])
+
         def do_machine(m):
-            defn = self.definitions[m.name]
+            defn = self.definitions.get(m.name)
             attrs_list = attrs_per_resource[m.name]
 
             # Emit configuration to realise encrypted peer-to-peer links.
-            for m2 in active_resources.itervalues():
-                ip = m.address_to(m2)
-                if ip:
-                    hosts[m.name][ip] += [m2.name, m2.name + "-unencrypted"]
-
             # Always use the encrypted/unencrypted suffixes for aliases rather
             # than for the canonical name!
             hosts[m.name]["127.0.0.1"].append(m.name + "-encrypted")
 
-            for m2_name in defn.encrypted_links_to:
+            for m2_name in encrypted_links_to(m):
 
                 if m2_name not in active_machines:
                     raise Exception("‘deployment.encryptedLinksTo’ in machine ‘{0}’ refers to an unknown machine ‘{1}’"
@@ -433,7 +596,7 @@ class Deployment(object):
                 m2 = active_machines[m2_name]
 
                 # Don't create two tunnels between a pair of machines.
-                if m.name in self.definitions[m2.name].encrypted_links_to and m.name >= m2.name:
+                if m.name in encrypted_links_to(m2) and m.name >= m2.name:
                     continue
                 local_ipv4 = index_to_private_ip(m.index)
                 remote_ipv4 = index_to_private_ip(m2.index)
@@ -478,7 +641,7 @@ class Deployment(object):
                 })
 
             # Set system.stateVersion if the Nixpkgs version supports it.
-            if nixops.util.parse_nixos_version(defn.config["nixosRelease"]) >= ["15", "09"]:
+            if defn and nixops.util.parse_nixos_version(defn.config["nixosRelease"]) >= ["15", "09"]:
                 attrs_list.append({
                     ('system', 'stateVersion'): Call(RawValue("lib.mkDefault"), m.state_version or defn.config["nixosRelease"])
                 })
@@ -488,9 +651,24 @@ class Deployment(object):
                     ('system', 'nixosVersionSuffix'): self.nixos_version_suffix
                 })
 
-        for m in active_machines.itervalues():
+        for m in sorted(active_machines.itervalues(), key=lambda m: m.name):
             do_machine(m)
 
+        # Add SSH public host keys for all machines in network.
+        # Using references to files in same tempdir for now, until NixOS has support
+        # for adding the keys directly as string. This way at least it is compatible
+        # with older versions of NixOS as well.
+        # TODO: after reasonable amount of time replace with string option
+        known_hosts = {}
+        for m2 in active_machines.itervalues():
+            if hasattr(m2, 'public_host_key') and m2.public_host_key:
+                known_hosts[m2.name] = {
+                    'hostNames': [m2.name + "-unencrypted",
+                                  m2.name + "-encrypted",
+                                  m2.name],
+                    'publicKey': m2.public_host_key,
+                }
+
         def emit_resource(r):
             config = []
             config.extend(attrs_per_resource[r.name])
@@ -500,7 +678,7 @@ class Deployment(object):
                                       key=lambda item: item[1][0])
                 # Just to remember the format:
                 #   ip_address canonical_hostname [aliases...]
-                extra_hosts = ["{0} {1}".format(ip, ' '.join(names))
+                extra_hosts = ["{0} {1}\n".format(ip, ' '.join(names))
                                for ip, names in sorted_hosts]
 
                 if authorized_keys[r.name]:
@@ -514,31 +692,20 @@ class Deployment(object):
                     })
 
                 config.append({
-                    ('boot', 'kernelModules'): list(kernel_modules[r.name]),
+                    ('boot', 'kernelModules'): sorted(kernel_modules[r.name]),
                     ('networking', 'firewall'): {
-                        'trustedInterfaces': list(trusted_interfaces[r.name])
+                        'trustedInterfaces': sorted(trusted_interfaces[r.name])
                     },
-                    ('networking', 'extraHosts'): '\n'.join(extra_hosts) + "\n"
+                    ('networking', 'extraHosts'):
+                        Call(Call(RawValue("extraHostsFor"), dict(host_overrides[r.name])), ''.join(extra_hosts))
                 })
 
+                if known_hosts:
+                    config.append({
+                        ('services', 'openssh', 'knownHosts'): RawValue("knownHosts")
+                    })
 
-                # Add SSH public host keys for all machines in network.
-                for m2 in active_machines.itervalues():
-                    if hasattr(m2, 'public_host_key') and m2.public_host_key:
-                        # Using references to files in same tempdir for now, until NixOS has support
-                        # for adding the keys directly as string. This way at least it is compatible
-                        # with older versions of NixOS as well.
-                        # TODO: after reasonable amount of time replace with string option
-                        config.append({
-                            ('services', 'openssh', 'knownHosts', m2.name): {
-                                 'hostNames': [m2.name + "-unencrypted",
-                                               m2.name + "-encrypted",
-                                               m2.name],
-                                 'publicKey': m2.public_host_key,
-                            }
-                        })
-
-            merged = reduce(nixmerge, config) if len(config) > 0 else {}
+            merged = NixMergeBuilder(config).get({})
             physical = r.get_physical_spec()
 
             if len(merged) == 0 and len(physical) == 0:
@@ -551,9 +718,40 @@ class Deployment(object):
                     })
                 })
 
-        return py2nix(reduce(nixmerge, [
-            emit_resource(r) for r in active_resources.itervalues()
-        ], {})) + "\n"
+        # Bindings shared by all machines.  ‘extraHostsFor’ returns
+        # the /etc/hosts lines of a machine, given the addresses that
+        # differ from ‘hosts’ and the machine's other lines.
+        shared = {
+            'hosts': shared_hosts,
+            'knownHosts': known_hosts,
+            'extraHostsFor': MultiLineRawValue([
+                'overrides: extra:',
+                '  let addresses = hosts // overrides; in',
+                '  builtins.concatStringsSep "" (builtins.map',
+                '    (name: "${builtins.getAttr name addresses} ${name} ${name}-unencrypted\\n")',
+                '    (builtins.filter (name: builtins.getAttr name addresses != null)',
+                '      (builtins.attrNames addresses)))',
+                '  + extra',
+            ]),
+        }
+
+        f.write(py2nix_let(shared) + "\n")
+
+        # Only the resources whose part of the spec changed since the
+        # last call are rendered again.
+        bindings = []
+        for r in sorted(active_resources.itervalues(), key=lambda r: r.name):
+            bindings.extend(self._physical_cache.get_bindings(r.name, emit_resource(r)))
+        for name in set(self._physical_cache.fragments) - set(active_resources):
+            del self._physical_cache.fragments[name]
+        if bindings:
+            f.write("{\n")
+            for b in bindings:
+                f.write(b)
+                f.write("\n")
+            f.write("}\n")
+        else:
+            f.write("{}\n")
 
     def get_profile(self):
         profile_dir = "/nix/var/nix/profiles/per-user/" + getpass.getuser()
@@ -569,10 +767,10 @@ class Deployment(object):
         return profile
 
 
-    def build_configs(self, include, exclude, dry_run=False, repair=False):
-        """Build the machine configurations in the Nix store."""
-
-        self.logger.log("building all machine configurations...")
+    def _prepare_build(self, include, exclude):
+        """Write the physical spec and set up remote building if
+        necessary.  Return the path of the physical spec and the
+        selected machines."""
 
         # Set the NixOS version suffix, if we're building from Git.
         # That way ‘nixos-version’ will show something useful on the
@@ -584,14 +782,14 @@ class Deployment(object):
             self.nixos_version_suffix = subprocess.check_output(["/bin/sh", get_version_script] + self._nix_path_flags()).rstrip()
 
         phys_expr = self.tempdir + "/physical.nix"
-        p = self.get_physical_spec()
-        nixops.util.write_file(phys_expr, p)
-        if debug: print >> sys.stderr, "generated physical spec:\n" + p
+        with open(phys_expr, "w") as f:
+            self.write_physical_spec(f)
+        if debug:
+            with open(phys_expr) as f:
+                print >> sys.stderr, "generated physical spec:\n" + f.read()
 
         selected = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
 
-        names = map(lambda m: m.name, selected)
-
         # If we're not running on Linux, then perform the build on the
         # target machines.  FIXME: Also enable this if we're on 32-bit
         # and want to deploy to 64-bit.
@@ -620,26 +818,198 @@ class Deployment(object):
             if not os.path.exists(load_dir): os.makedirs(load_dir, 0700)
             os.environ['NIX_CURRENT_LOAD'] = load_dir
 
-        try:
-            configs_path = subprocess.check_output(
-                ["nix-build"]
-                + self._eval_flags(self.nix_exprs + [phys_expr]) +
-                ["--arg", "names", py2nix(names, inline=True),
-                 "-A", "machines", "-o", self.tempdir + "/configs"]
-                + (["--dry-run"] if dry_run else [])
-                + (["--repair"] if repair else []),
-                stderr=self.logger.log_file).rstrip()
-        except subprocess.CalledProcessError:
-            raise Exception("unable to build all machine configurations")
+        return phys_expr, selected
 
-        if self.rollback_enabled and not dry_run:
+
+    def build_configs(self, include, exclude, dry_run=False, repair=False, instantiated=None):
+        """Build the machine configurations in the Nix store.  If
+        given, ‘instantiated’ is the result of instantiate_configs()."""
+
+        self.logger.log("building all machine configurations...")
+
+        selected, drvs = instantiated or self.instantiate_configs(include, exclude)
+
+        with self._timed("build"):
+            try:
+                out = subprocess.check_output(
+                    ["nix-store", "-r", drvs["machines"]["drvPath"], "--add-root", self.tempdir + "/configs", "--indirect"]
+                    + self.extra_nix_flags
+                    + (["--dry-run"] if dry_run else [])
+                    + (["--repair"] if repair else []),
+                    stderr=self.logger.log_file).rstrip()
+            except subprocess.CalledProcessError:
+                raise Exception("unable to build all machine configurations")
+            configs_path = os.path.realpath(out) if out else out
+
+        if not dry_run: self._set_configs_profile(configs_path)
+
+        return configs_path
+
+
+    def _set_configs_profile(self, configs_path):
+        if self.rollback_enabled:
             profile = self.create_profile()
             if subprocess.call(["nix-env", "-p", profile, "--set", configs_path]) != 0:
                 raise Exception("cannot update profile ‘{0}’".format(profile))
 
+
+    def build_and_copy_configs(self, include, exclude, max_concurrent_build,
+                               max_concurrent_copy, repair=False, activate=None, instantiated=None):
+        """Build the configuration of each machine as a separate job,
+        and copy its closure to the machine as soon as it has been
+        built, so that a slow build doesn't hold up the other machines.
+        If ‘activate’ is given, it is called with each machine and the
+        path of the configurations once the machine's closure has been
+        copied, and should return the machine's name if activation
+        failed.  If given, ‘instantiated’ is the result of
+        instantiate_configs().  Return the path of the
+        configurations."""
+
+        self.logger.log("building machine configurations...")
+
+        selected, drvs = instantiated or self.instantiate_configs(include, exclude)
+        configs_path = drvs["machines"]["outPath"]
+
+        build_slots = threading.Semaphore(max_concurrent_build)
+        copy_slots = threading.Semaphore(max_concurrent_copy)
+
+        def worker(m):
+            with build_slots:
+                m.logger.log("building configuration...")
+                try:
+                    out = subprocess.check_output(
+                        ["nix-store", "-r", drvs["toplevels"][m.name],
+                         "--add-root", "{0}/toplevel-{1}".format(self.tempdir, m.name), "--indirect"]
+                        + self.extra_nix_flags
+                        + (["--repair"] if repair else []),
+                        stderr=self.logger.log_file).rstrip()
+                except subprocess.CalledProcessError:
+                    raise Exception("unable to build the configuration of machine ‘{0}’".format(m.name))
+                m.new_toplevel = os.path.realpath(out)
+            with copy_slots:
+                m.logger.log("copying closure...")
+                m.copy_closure_to(m.new_toplevel)
+            return activate(m, configs_path) if activate else None
+
+        with self._timed("pipeline"):
+            res = nixops.parallel.run_tasks(nr_workers=-1, tasks=selected, worker_fun=worker)
+
+        # All machine configurations are built now, so this only
+        # creates the symlinks to them.
+        try:
+            subprocess.check_output(
+                ["nix-store", "-r", drvs["machines"]["drvPath"],
+                 "--add-root", self.tempdir + "/configs", "--indirect"] + self.extra_nix_flags,
+                stderr=self.logger.log_file)
+        except subprocess.CalledProcessError:
+            raise Exception("unable to build all machine configurations")
+        self._set_configs_profile(configs_path)
+
+        self._check_activation_results(res)
         return configs_path
 
 
+    def instantiate_configs(self, include, exclude):
+        """Write the physical spec and instantiate the configurations
+        of the selected machines in a single evaluation.  Return the
+        selected machines and their derivations (see
+        _instantiate_toplevels()), which build_configs() and
+        build_and_copy_configs() realise without evaluating again."""
+        phys_expr, selected = self._prepare_build(include, exclude)
+        with self._timed("instantiation"):
+            drvs = self._instantiate_toplevels(phys_expr, [m.name for m in selected])
+        return selected, drvs
+
+
+    def _instantiate_toplevels(self, phys_expr, names):
+        """Instantiate the configurations of the machines in ‘names’
+        in a single evaluation.  Return the derivation and output path
+        of the combined configurations, and the derivation of the
+        configuration of each machine.  With the evaluation cache
+        enabled, the derivations of an earlier deployment are reused if
+        nothing they depend on has changed, so that the NixOS
+        configurations are not evaluated again."""
+        argv = (["nix-instantiate", "--eval-only", "--strict", "--json", "--read-write-mode"]
+                + self._eval_flags(self.nix_exprs + [phys_expr]) +
+                ["--arg", "names", py2nix(names, inline=True), "-A", "machineDrvs"])
+
+        key = None
+        if self.use_eval_cache:
+            # The physical spec is in a temporary file, so use its
+            # contents rather than its path in the key.
+            with open(phys_expr) as f: phys_hash = hashlib.sha256(f.read()).hexdigest()
+            key = nixops.eval_cache.get_key(
+                [phys_hash if arg == phys_expr else arg.replace(phys_expr, phys_hash) for arg in argv],
+                self.nix_exprs, self.extra_nix_path + self.nix_path, self.expr_path)
+            out = nixops.eval_cache.get(key, suffix=".drvs") if key else None
+            if out:
+                drvs = json.loads(out)
+                if all(os.path.exists(p) for p in [drvs["machines"]["drvPath"]] + drvs["toplevels"].values()):
+                    self.logger.log("reusing instantiated machine configurations...")
+                    return drvs
+
+        try:
+            out = subprocess.check_output(argv, stderr=self.logger.log_file)
+        except subprocess.CalledProcessError:
+            raise Exception("unable to instantiate all machine configurations")
+
+        if key: nixops.eval_cache.put(key, out, suffix=".drvs")
+        return json.loads(out)
+
+
+    @contextlib.contextmanager
+    def _timed(self, phase):
+        """Record the duration of the enclosed code as ‘phase’ in
+        ‘phase_times’."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phase_times.append((phase, time.time() - start))
+
+
+    def _get_create_dependencies(self, r, include, exclude):
+        """Return the active resources that must be created before
+        resource ‘r’.  Resources that are not selected by ‘include’
+        and ‘exclude’ have no definition, and are not created, so
+        nothing needs to wait for them."""
+        defn = self.definitions.get(r.name)
+        if not should_do(r, include, exclude) or defn is None: return []
+        return r.create_after(self.active_resources.itervalues(), defn)
+
+
+    def _get_duration_estimate(self, action, include, exclude):
+        """Return a function that gives the expected time in seconds to
+        perform ‘action’ (‘create’ or ‘destroy’) on a resource, based on
+        the durations recorded for its type.  Creating a resource that
+        already exists and is up is expected to take no time, since
+        create() then only checks or updates it."""
+        averages = self.resource_durations.get(action, {})
+        default = sum(averages.values()) / len(averages) if averages else 1.0
+        def estimate(r):
+            if not should_do(r, include, exclude): return 0
+            if action == "create" and r.creation_time and r.state == r.UP: return 0
+            return averages.get(r.get_type(), default)
+        return estimate
+
+
+    def _record_durations(self, action, samples):
+        """Update the recorded durations of ‘action’ with ‘samples’, a
+        list of (resource type, seconds) pairs."""
+        if not samples: return
+        by_type = {}
+        for (resource_type, secs) in samples:
+            by_type.setdefault(resource_type, []).append(secs)
+        durations = self.resource_durations
+        averages = durations.get(action, {})
+        for resource_type, secs in by_type.iteritems():
+            secs = sum(secs) / len(secs)
+            old = averages.get(resource_type)
+            averages[resource_type] = round(secs if old is None else (old + secs) / 2, 2)
+        durations[action] = averages
+        self.resource_durations = durations
+
+
     def copy_closures(self, configs_path, include, exclude, max_concurrent_copy):
         """Copy the closure of each machine configuration to the corresponding machine."""
 
@@ -663,78 +1033,90 @@ class Deployment(object):
 
         def worker(m):
             if not should_do(m, include, exclude): return
+            return self._activate_machine(
+                m, configs_path, allow_reboot=allow_reboot, force_reboot=force_reboot,
+                sync=sync, always_activate=always_activate, dry_activate=dry_activate)
 
-            try:
-                # Set the system profile to the new configuration.
-                daemon_var = '' if m.state == m.RESCUE else 'env NIX_REMOTE=daemon '
-                setprof = daemon_var + 'nix-env -p /nix/var/nix/profiles/system --set "{0}"'
-                if always_activate or self.definitions[m.name].always_activate:
-                    m.run_command(setprof.format(m.new_toplevel))
-                else:
-                    # Only activate if the profile has changed.
-                    new_profile_cmd = '; '.join([
-                        'old_gen="$(readlink -f /nix/var/nix/profiles/system)"',
-                        'new_gen="$(readlink -f "{0}")"',
-                        '[ "x$old_gen" != "x$new_gen" ] || exit 111',
-                        setprof
-                    ]).format(m.new_toplevel)
-
-                    ret = m.run_command(new_profile_cmd, check=False)
-                    if ret == 111:
-                        m.log("configuration already up to date")
-                        return
-                    elif ret != 0:
-                        raise Exception("unable to set new system profile")
-
-                m.send_keys()
-
-                if force_reboot or m.state == m.RESCUE:
-                    switch_method = "boot"
-                elif dry_activate:
-                    switch_method = "dry-activate"
-                else:
-                    switch_method = "switch"
+        res = nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active.itervalues(), worker_fun=worker)
+        self._check_activation_results(res)
+
+
+    def _check_activation_results(self, res):
+        failed = [x for x in res if x != None]
+        if failed != []:
+            raise Exception("activation of {0} of {1} machines failed (namely on {2})"
+                            .format(len(failed), len(res), ", ".join(["‘{0}’".format(x) for x in failed])))
 
-                # Run the switch script.  This will also update the
-                # GRUB boot loader.
-                res = m.switch_to_configuration(switch_method, sync)
 
-                if dry_activate: return
+    def _activate_machine(self, m, configs_path, allow_reboot, force_reboot,
+                          sync, always_activate, dry_activate):
+        """Activate the new configuration on machine ‘m’.  Return the
+        name of the machine if this failed, and None otherwise."""
+        try:
+            # Set the system profile to the new configuration.
+            daemon_var = '' if m.state == m.RESCUE else 'env NIX_REMOTE=daemon '
+            setprof = daemon_var + 'nix-env -p /nix/var/nix/profiles/system --set "{0}"'
+            if always_activate or self.definitions[m.name].always_activate:
+                m.run_command(setprof.format(m.new_toplevel))
+            else:
+                # Only activate if the profile has changed.
+                new_profile_cmd = '; '.join([
+                    'old_gen="$(readlink -f /nix/var/nix/profiles/system)"',
+                    'new_gen="$(readlink -f "{0}")"',
+                    '[ "x$old_gen" != "x$new_gen" ] || exit 111',
+                    setprof
+                ]).format(m.new_toplevel)
+
+                ret = m.run_command(new_profile_cmd, check=False)
+                if ret == 111:
+                    m.log("configuration already up to date")
+                    return
+                elif ret != 0:
+                    raise Exception("unable to set new system profile")
 
-                if res != 0 and res != 100:
-                    raise Exception("unable to activate new configuration")
+            m.send_keys()
 
-                if res == 100 or force_reboot or m.state == m.RESCUE:
-                    if not allow_reboot and not force_reboot:
-                        raise Exception("the new configuration requires a "
-                                        "reboot to take effect (hint: use "
-                                        "‘--allow-reboot’)".format(m.name))
-                    m.reboot_sync()
-                    res = 0
-                    # FIXME: should check which systemd services
-                    # failed to start after the reboot.
+            if force_reboot or m.state == m.RESCUE:
+                switch_method = "boot"
+            elif dry_activate:
+                switch_method = "dry-activate"
+            else:
+                switch_method = "switch"
 
-                if res == 0:
-                    m.success("activation finished successfully")
+            # Run the switch script.  This will also update the
+            # GRUB boot loader.
+            res = m.switch_to_configuration(switch_method, sync)
 
-                # Record that we switched this machine to the new
-                # configuration.
-                m.cur_configs_path = configs_path
-                m.cur_toplevel = m.new_toplevel
+            if dry_activate: return
 
-            except Exception as e:
-                # This thread shouldn't throw an exception because
-                # that will cause NixOps to exit and interrupt
-                # activation on the other machines.
-                m.logger.error(traceback.format_exc())
-                return m.name
-            return None
+            if res != 0 and res != 100:
+                raise Exception("unable to activate new configuration")
 
-        res = nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active.itervalues(), worker_fun=worker)
-        failed = [x for x in res if x != None]
-        if failed != []:
-            raise Exception("activation of {0} of {1} machines failed (namely on {2})"
-                            .format(len(failed), len(res), ", ".join(["‘{0}’".format(x) for x in failed])))
+            if res == 100 or force_reboot or m.state == m.RESCUE:
+                if not allow_reboot and not force_reboot:
+                    raise Exception("the new configuration requires a "
+                                    "reboot to take effect (hint: use "
+                                    "‘--allow-reboot’)".format(m.name))
+                m.reboot_sync()
+                res = 0
+                # FIXME: should check which systemd services
+                # failed to start after the reboot.
+
+            if res == 0:
+                m.success("activation finished successfully")
+
+            # Record that we switched this machine to the new
+            # configuration.
+            m.cur_configs_path = configs_path
+            m.cur_toplevel = m.new_toplevel
+
+        except Exception as e:
+            # This thread shouldn't throw an exception because
+            # that will cause NixOps to exit and interrupt
+            # activation on the other machines.
+            m.logger.error(traceback.format_exc())
+            return m.name
+        return None
 
 
     def _get_free_resource_index(self):
@@ -833,13 +1215,23 @@ class Deployment(object):
 
 
     def evaluate_active(self, include=[], exclude=[], kill_obsolete=False):
-        self.evaluate()
+        # Only evaluate the selected machines, unless we need the
+        # encrypted links of machines whose links haven't been
+        # recorded yet (see get_physical_spec()).
+        if all(m.encrypted_links_to is not None for m in self.active.itervalues()):
+            self.evaluate(include, exclude)
+        else:
+            self.evaluate()
 
         # Create state objects for all defined resources.
         with self._db:
             for m in self.definitions.itervalues():
                 if m.name not in self.resources:
                     self._create_resource(m.name, m.get_type())
+                r = self.resources[m.name]
+                if is_machine(r) and is_machine_defn(m):
+                    links = sorted(m.encrypted_links_to)
+                    if r.encrypted_links_to != links: r.encrypted_links_to = links
 
         self.logger.update_log_prefixes()
 
@@ -853,6 +1245,8 @@ class Deployment(object):
                 if m.obsolete:
                     self.logger.log("resource ‘{0}’ is no longer obsolete".format(m.name))
                     m.obsolete = False
+            elif m.name in self.defined_names:
+                pass # not evaluated
             else:
                 self.logger.log("resource ‘{0}’ is obsolete".format(m.name))
                 if not m.obsolete: m.obsolete = True
@@ -867,58 +1261,56 @@ class Deployment(object):
     def _deploy(self, dry_run=False, build_only=False, create_only=False, copy_only=False, evaluate_only=False,
                 include=[], exclude=[], check=False, kill_obsolete=False,
                 allow_reboot=False, allow_recreate=False, force_reboot=False,
-                max_concurrent_copy=5, sync=True, always_activate=False, repair=False, dry_activate=False):
+                max_concurrent_copy=5, sync=True, always_activate=False, repair=False, dry_activate=False,
+                pipeline=False, max_concurrent_build=2, activate_early=False, verify=False,
+                max_concurrent_create=-1):
         """Perform the deployment defined by the deployment specification."""
 
-        self.evaluate_active(include, exclude, kill_obsolete)
+        with self._timed("evaluation"):
+            self.evaluate_active(include, exclude, kill_obsolete)
 
         if evaluate_only:
             return
 
         # Assign each resource an index if it doesn't have one.
-        for r in self.active_resources.itervalues():
-            if r.index == None:
-                r.index = self._get_free_resource_index()
-                # FIXME: Logger should be able to do coloring without the need
-                #        for an index maybe?
-                r.logger.register_index(r.index)
+        with self._journal_attrs(self.active_resources.values()):
+            for r in self.active_resources.itervalues():
+                if r.index == None:
+                    r.index = self._get_free_resource_index()
+                    # FIXME: Logger should be able to do coloring without the need
+                    #        for an index maybe?
+                    r.logger.register_index(r.index)
 
         self.logger.update_log_prefixes()
 
-        # Start or update the active resources.  Non-machine resources
-        # are created first, because machines may depend on them
-        # (e.g. EC2 machines depend on EC2 key pairs or EBS volumes).
-        # FIXME: would be nice to have a more fine-grained topological
-        # sort.
+        # Start or update the active resources.  A resource is created
+        # once the resources it depends on (e.g. the EC2 key pairs or
+        # EBS volumes of an EC2 machine) have been created.
         if not dry_run and not build_only:
 
             for r in self.active_resources.itervalues():
-                defn = self.definitions[r.name]
-                if r.get_type() != defn.get_type():
+                defn = self.definitions.get(r.name)
+                if defn and r.get_type() != defn.get_type():
                     raise Exception("the type of resource ‘{0}’ changed from ‘{1}’ to ‘{2}’, which is currently unsupported"
                                     .format(r.name, r.get_type(), defn.get_type()))
-                r._created_event = threading.Event()
-                r._errored = False
 
-            def worker(r):
-                try:
-                    if not should_do(r, include, exclude): return
-
-                    # Sleep until all dependencies of this resource have
-                    # been created.
-                    deps = r.create_after(self.active_resources.itervalues(), self.definitions[r.name])
-                    for dep in deps:
-                        dep._created_event.wait()
-                        # !!! Should we print a message here?
-                        if dep._errored:
-                            r._errored = True
-                            return
-
-                    # Now create the resource itself.
-                    if not r.creation_time:
-                        r.creation_time = int(time.time())
-                    r.create(self.definitions[r.name], check=check, allow_reboot=allow_reboot, allow_recreate=allow_recreate)
+            durations = []
 
+            def worker(r):
+                if not should_do(r, include, exclude): return
+
+                # Only record how long it takes to actually create a
+                # resource, not to check one that already exists.
+                missing = not r.creation_time or r.state == r.MISSING
+                start = time.time()
+                if not r.creation_time:
+                    r.creation_time = int(time.time())
+                # Not journalled, so that the identity of a new cloud
+                # resource (e.g. the ID of an EC2 instance) is in the
+                # state file as soon as create() records it.
+                r.create(self.definitions[r.name], check=check, allow_reboot=allow_reboot, allow_recreate=allow_recreate)
+
+                with self._journal_attrs([r]):
                     if is_machine(r):
                         # The first time the machine is created,
                         # record the state version. We get it from
@@ -937,40 +1329,89 @@ class Deployment(object):
 
                         r.wait_for_ssh(check=check)
                         r.generate_vpn_key(check=check)
+                if missing and r.state == r.UP:
+                    durations.append((r.get_type(), time.time() - start))
 
-                except:
-                    r._errored = True
-                    raise
-                finally:
-                    r._created_event.set()
-
-            nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active_resources.itervalues(), worker_fun=worker)
+            # Start the resources with the longest chains of (slow)
+            # resources depending on them first.
+            try:
+                with self._timed("creation"):
+                    nixops.parallel.run_dag(nr_workers=max_concurrent_create, tasks=self.active_resources.values(),
+                                            dependencies=lambda r: self._get_create_dependencies(r, include, exclude),
+                                            worker_fun=worker,
+                                            duration=self._get_duration_estimate("create", include, exclude))
+            finally:
+                self._record_durations("create", durations)
 
         if create_only: return
 
+        # Skip building, copying and activation if nothing changed
+        # since the last successful deployment.
+        fast_path = not (dry_run or build_only or copy_only or dry_activate or check
+                         or always_activate or force_reboot or repair)
+        # Instantiate the machine configurations once; the build
+        # below realises the same derivations.
+        instantiated = self.instantiate_configs(include, exclude)
+        toplevel_drvs = instantiated[1]["toplevels"]
+        if fast_path:
+            fingerprint = self._get_deploy_fingerprint(toplevel_drvs, include, exclude)
+            if fingerprint and fingerprint == self.deploy_fingerprint:
+                if not verify or self._verify_toplevels(include, exclude):
+                    self.logger.log(ansi_success("{0}> nothing to do: deployment unchanged since the last deploy"
+                                                 .format(self.name), outfile=self.logger._log_file))
+                    return
+            if self.deploy_fingerprint: self.deploy_fingerprint = None
+
         # Build the machine configurations.
         if dry_run:
-            self.build_configs(dry_run=dry_run, repair=repair, include=include, exclude=exclude)
+            self.build_configs(dry_run=dry_run, repair=repair, include=include, exclude=exclude,
+                               instantiated=instantiated)
             return
 
-        # Record configs_path in the state so that the ‘info’ command
-        # can show whether machines have an outdated configuration.
-        self.configs_path = self.build_configs(repair=repair, include=include, exclude=exclude)
-
-        if build_only: return
-
-        # Copy the closures of the machine configurations to the
-        # target machines.
-        self.copy_closures(self.configs_path, include=include, exclude=exclude,
-                           max_concurrent_copy=max_concurrent_copy)
+        activated = False
+
+        if pipeline and not build_only:
+            # Build each machine configuration separately and copy
+            # its closure as soon as it's built.  With
+            # ‘activate_early’, also activate it right away, rather
+            # than waiting for all machines.
+            activate = None
+            if activate_early and not copy_only:
+                activated = True
+                def activate(m, configs_path):
+                    return self._activate_machine(
+                        m, configs_path, allow_reboot=allow_reboot, force_reboot=force_reboot,
+                        sync=sync, always_activate=always_activate, dry_activate=dry_activate)
+
+            with self._journal_attrs(self.active.values() if activated else []):
+                self.configs_path = self.build_and_copy_configs(
+                    include=include, exclude=exclude, max_concurrent_build=max_concurrent_build,
+                    max_concurrent_copy=max_concurrent_copy, repair=repair, activate=activate,
+                    instantiated=instantiated)
+
+        else:
+            # Record configs_path in the state so that the ‘info’ command
+            # can show whether machines have an outdated configuration.
+            self.configs_path = self.build_configs(repair=repair, include=include, exclude=exclude,
+                                                   instantiated=instantiated)
+
+            if build_only: return
+
+            # Copy the closures of the machine configurations to the
+            # target machines.
+            with self._timed("copy"):
+                self.copy_closures(self.configs_path, include=include, exclude=exclude,
+                                   max_concurrent_copy=max_concurrent_copy)
 
         if copy_only: return
 
         # Active the configurations.
-        self.activate_configs(self.configs_path, include=include,
-                              exclude=exclude, allow_reboot=allow_reboot,
-                              force_reboot=force_reboot, check=check,
-                              sync=sync, always_activate=always_activate, dry_activate=dry_activate)
+        if not activated:
+            with self._timed("activation"), self._journal_attrs(self.active.values()):
+                self.activate_configs(self.configs_path, include=include,
+                                      exclude=exclude, allow_reboot=allow_reboot,
+                                      force_reboot=force_reboot, check=check,
+                                      sync=sync, always_activate=always_activate, dry_activate=dry_activate)
 
         if dry_activate: return
 
@@ -982,12 +1423,60 @@ class Deployment(object):
             # Now create the resource itself.
             r.after_activation(self.definitions[r.name])
 
-        nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active_resources.itervalues(), worker_fun=cleanup_worker)
+        with self._journal_attrs(self.active_resources.values()):
+            nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active_resources.itervalues(), worker_fun=cleanup_worker)
+
+        if fast_path:
+            self.deploy_fingerprint = self._get_deploy_fingerprint(toplevel_drvs, include, exclude)
+
         self.logger.log(ansi_success("{0}> deployment finished successfully".format(self.name), outfile=self.logger._log_file))
 
+    def _get_deploy_fingerprint(self, toplevel_drvs, include, exclude):
+        """Return a hash of everything that determines the result of
+        deploying the selected machines: the derivation of each
+        machine's configuration (see instantiate_configs()), which
+        covers everything the evaluation depended on, the keys that
+        are uploaded at activation time (which are not part of the
+        configuration if storeKeysOnMachine is false), and the
+        configuration currently active on each machine.  Return None
+        if a machine has no active configuration."""
+        h = hashlib.sha256()
+        h.update("configs {0}\0".format(self.configs_path))
+        for m in sorted(self.active.itervalues(), key=lambda m: m.name):
+            if not should_do(m, include, exclude): continue
+            if not m.cur_toplevel: return None
+            h.update("\0machine {0} {1} {2}".format(m.name, toplevel_drvs[m.name], m.cur_toplevel))
+            h.update("\0keys {0}".format(json.dumps(m.get_keys(), sort_keys=True)))
+        return h.hexdigest()
+
+
+    def _verify_toplevels(self, include, exclude):
+        """Check that the selected machines are still running the
+        configuration that was last deployed to them."""
+        def worker(m):
+            if not should_do(m, include, exclude): return None
+            try:
+                toplevel = m.run_command("readlink -f /nix/var/nix/profiles/system",
+                                         capture_stdout=True).rstrip()
+            except Exception as e:
+                m.warn("cannot verify the system profile: {0}".format(e))
+                return m.name
+            if toplevel == m.cur_toplevel: return None
+            m.warn("system profile is ‘{0}’ rather than ‘{1}’".format(toplevel, m.cur_toplevel))
+            return m.name
+        res = nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active.itervalues(), worker_fun=worker)
+        return all(x == None for x in res)
+
+
     def deploy(self, **kwargs):
         with self._get_deployment_lock():
-            self._deploy(**kwargs)
+            self.phase_times = []
+            try:
+                self._deploy(**kwargs)
+            finally:
+                if debug and self.phase_times:
+                    print >> sys.stderr, "phase timing: " + ", ".join(
+                        "{0} {1:.2f}s".format(phase, secs) for phase, secs in self.phase_times)
 
 
     def _rollback(self, generation, include=[], exclude=[], check=False,
@@ -1034,43 +1523,37 @@ class Deployment(object):
             self._rollback(**kwargs)
 
 
-    def _destroy_resources(self, include=[], exclude=[], wipe=False):
+    def _destroy_resources(self, include=[], exclude=[], wipe=False, max_concurrent_destroy=-1):
 
+        # A resource is destroyed once the resources that must be
+        # destroyed before it have been destroyed.
+        wait_for = {r.name: [] for r in self.resources.itervalues()}
         for r in self.resources.itervalues():
-            r._destroyed_event = threading.Event()
-            r._errored = False
             for rev_dep in r.destroy_before(self.resources.itervalues()):
-                try:
-                    rev_dep._wait_for.append(r)
-                except AttributeError:
-                    rev_dep._wait_for = [ r ]
+                wait_for[rev_dep.name].append(r)
+
+        durations = []
 
         def worker(m):
-            try:
-                if not should_do(m, include, exclude): return
-                try:
-                    for dep in m._wait_for:
-                        dep._destroyed_event.wait()
-                        # !!! Should we print a message here?
-                        if dep._errored:
-                            m._errored = True
-                            return
-                except AttributeError:
-                    pass
-                if m.destroy(wipe=wipe): self.delete_resource(m)
-            except:
-                m._errored = True
-                raise
-            finally:
-                m._destroyed_event.set()
+            if not should_do(m, include, exclude): return
+            existed = m.state not in (m.UNKNOWN, m.MISSING)
+            start = time.time()
+            if m.destroy(wipe=wipe):
+                self.delete_resource(m)
+                if existed: durations.append((m.get_type(), time.time() - start))
 
-        nixops.parallel.run_tasks(nr_workers=-1, tasks=self.resources.values(), worker_fun=worker)
+        try:
+            nixops.parallel.run_dag(nr_workers=max_concurrent_destroy, tasks=self.resources.values(),
+                                    dependencies=lambda m: wait_for[m.name], worker_fun=worker,
+                                    duration=self._get_duration_estimate("destroy", include, exclude))
+        finally:
+            self._record_durations("destroy", durations)
 
-    def destroy_resources(self, include=[], exclude=[], wipe=False):
+    def destroy_resources(self, include=[], exclude=[], wipe=False, max_concurrent_destroy=-1):
         """Destroy all active and obsolete resources."""
 
         with self._get_deployment_lock():
-            self._destroy_resources(include, exclude, wipe)
+            self._destroy_resources(include, exclude, wipe, max_concurrent_destroy)
 
         # Remove the destroyed machines from the rollback profile.
         # This way, a subsequent "nix-env --delete-generations old" or
@@ -1156,6 +1639,159 @@ class Deployment(object):
         nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active.itervalues(), worker_fun=worker)
 
 
+class AttrJournal(object):
+    """Context manager that collects the attribute writes of a set of
+    resources in memory and writes them to the state file in a single
+    transaction when the context is left, either normally or through
+    an exception.  This replaces one commit (and fsync) per attribute
+    assignment with one per resource per deployment phase.
+
+    Crash safety: if a resource operation fails with an exception,
+    the writes it made so far are still flushed.  However, if the
+    process is killed, the machine crashes, or the deployment is
+    interrupted while worker threads are still running, the writes
+    journalled since the start of the current phase are lost.  For
+    this reason, ResourceState.create() is never journalled, since the
+    state file must record the cloud resources it creates (such as an
+    EC2 instance) right away.  The state file itself stays consistent,
+    because each flush is a single transaction."""
+
+    def __init__(self, depl, resources):
+        self._depl = depl
+        self._resources = resources
+        self._started = []
+
+    def __enter__(self):
+        # Only flush journals that we started, so that nested scopes
+        # don't end the journal of an enclosing one.
+        self._started = [r for r in self._resources if r._attr_journal is None]
+        for r in self._started:
+            r._start_attr_journal()
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        with nixops.statefile.Transaction(self._depl._db):
+            for r in self._started:
+                r._flush_attr_journal()
+
+
+class PhysicalSpecCache(object):
+    """Intermediate results of Deployment.write_physical_spec(), so
+    that when some resources change, only their part of the physical
+    spec is computed again.  A resource counts as changed if its type
+    or any of the attributes that determine its addresses changed (see
+    _address_key()).  The cache only lives in memory."""
+
+    def __init__(self):
+        self.keys = {}       # resource name -> address key
+        self.addresses = {}  # machine name -> {resource name: address}
+        self.counts = {}     # resource name -> {address: number of machines}
+        self.shared = {}     # resource name -> most common address
+        self.overrides = {}  # machine name -> {resource name: address}
+        self.fragments = {}  # resource name -> (fragment, bindings)
+
+    def _set_address(self, row, r_name, ip):
+        counts = self.counts.setdefault(r_name, {})
+        if r_name in row: self._uncount(r_name, row[r_name])
+        row[r_name] = ip
+        counts[ip] = counts.get(ip, 0) + 1
+
+    def _uncount(self, r_name, ip):
+        counts = self.counts.get(r_name)
+        if counts is None: return
+        counts[ip] -= 1
+        if counts[ip] == 0: del counts[ip]
+
+    @staticmethod
+    def _address_key(r):
+        """Return a hash of the type of ‘r’ and of the attributes that
+        the address_to() methods of machines look at."""
+        values = ["{0}.{1}".format(type(r).__module__, type(r).__name__)]
+        values.extend(getattr(r, a, None) for a in ("public_ipv4", "private_ipv4", "network", "host"))
+        return hashlib.sha256(json.dumps(values, default=str)).hexdigest()
+
+    def update_hosts(self, machines, resources):
+        """Update the address at which each machine in ‘machines’ can
+        reach each resource in ‘resources’.  Return the most common
+        address of each resource, and for each machine the addresses
+        that differ from it."""
+        keys = {r.name: self._address_key(r) for r in resources.itervalues()}
+        changed = set(n for n, k in keys.iteritems() if self.keys.get(n) != k)
+        removed = set(self.keys) - set(keys)
+        self.keys = keys
+
+        # Resources whose most common address may have changed, and
+        # the (machine, resource) pairs whose address was updated.
+        dirty = set()
+        updated = []
+
+        for m_name in self.addresses.keys():
+            if m_name not in machines or m_name in changed:
+                for r_name, ip in self.addresses.pop(m_name).iteritems():
+                    self._uncount(r_name, ip)
+                    dirty.add(r_name)
+                del self.overrides[m_name]
+        for r_name in removed:
+            self.counts.pop(r_name, None)
+            self.shared.pop(r_name, None)
+            dirty.discard(r_name)
+            for row in self.addresses.itervalues(): row.pop(r_name, None)
+            for row in self.overrides.itervalues(): row.pop(r_name, None)
+
+        # Only the new or changed machines and resources need to be
+        # looked at.
+        for m in machines.itervalues():
+            row = self.addresses.get(m.name)
+            if row is not None:
+                targets = [resources[n] for n in changed if n in resources]
+            else:
+                row = self.addresses[m.name] = {}
+                self.overrides[m.name] = {}
+                targets = resources.itervalues()
+            for r in targets:
+                self._set_address(row, r.name, m.address_to(r))
+                dirty.add(r.name)
+                updated.append((m.name, r.name))
+
+        for r_name in dirty:
+            counts = self.counts.get(r_name)
+            ip = max(sorted(counts.iteritems()), key=lambda item: item[1])[0] if counts else None
+            if self.shared.get(r_name) == ip: continue
+            if ip: self.shared[r_name] = ip
+            else: self.shared.pop(r_name, None)
+            updated.extend((m_name, r_name) for m_name in self.addresses)
+
+        for m_name, r_name in updated:
+            ip = self.addresses[m_name][r_name]
+            if ip != self.shared.get(r_name):
+                self.overrides[m_name][r_name] = ip
+            else:
+                self.overrides[m_name].pop(r_name, None)
+
+        return self.shared, self.overrides
+
+    def get_bindings(self, name, fragment):
+        """Return the Nix attribute bindings of the physical spec
+        ‘fragment’ of resource ‘name’, reusing the previous rendering
+        if the fragment didn't change."""
+        cached = self.fragments.get(name)
+        if cached and cached[0] == fragment: return cached[1]
+        bindings = py2nix_attrs(fragment)
+        self.fragments[name] = (fragment, bindings)
+        return bindings
+
+
+def _split_option_path(path):
+    """Split ‘machine.option’ into the machine name, the option, and
+    the attribute names of the option.  Names containing dots may be
+    quoted, e.g. ‘machine.fileSystems."/".device’."""
+    m = re.match(r'("[^"]*"|[^."]+)\.(.+)$', path)
+    if not m:
+        raise Exception("‘{0}’ is not of the form ‘machine.option’".format(path))
+    machine, option = m.group(1).strip('"'), m.group(2)
+    attrs = re.findall(r'"([^"]*)"|([^."]+)', option)
+    return machine, option, [quoted or plain for quoted, plain in attrs]
+
+
 def should_do(m, include, exclude):
     return should_do_n(m.name, include, exclude)
 
@@ -1170,16 +1806,23 @@ def is_machine(r):
 def is_machine_defn(r):
     return isinstance(r, nixops.backends.MachineDefinition)
 
+def machine_types():
+    """Return the resource type names of all machine backends."""
+    return [cls.get_type() for cls in _subclasses(nixops.backends.MachineState)]
+
 
 def _subclasses(cls):
     sub = cls.__subclasses__()
     return [cls] if not sub else [g for s in sub for g in _subclasses(s)]
 
-def _create_definition(xml, config, type_name):
-    """Create a resource definition object from the given XML representation of the machine's attributes."""
+def _create_definition(name, config, type_name):
+    """Create a resource definition object from the evaluated attributes of the resource."""
 
     for cls in _subclasses(nixops.resources.ResourceDefinition):
         if type_name == cls.get_resource_type():
+            # Definitions still get the attributes as XML as well; this
+            # is a view of ‘config’ rather than an actual XML tree.
+            xml = nixops.util.XmlExpr.attr(name, config)
             # FIXME: backward compatibility hack
             if len(inspect.getargspec(cls.__init__).args) == 2:
                 return cls(xml)
@@ -6,6 +6,8 @@ import boto.vpc
 import time
 import random
 import nixops.util
+import nixops.rate_limit
+import nixops.parallel
 
 from boto.exception import EC2ResponseError
 from boto.exception import SQSError
@@ -59,6 +61,13 @@ def fetch_aws_secret_key(access_key_id):
 
     return credentials
 
+def rate_limited(conn, service, region, access_key_id):
+    """Make all requests through the boto connection ‘conn’ subject to
+    the shared limits of ‘service’ in ‘region’ for the given access
+    key."""
+    bucket = nixops.rate_limit.get_bucket(service, region, access_key_id)
+    return nixops.rate_limit.limit_method(conn, "make_request", bucket)
+
 def connect(region, access_key_id):
     """Connect to the specified EC2 region using the given access key."""
     assert region
@@ -67,7 +76,7 @@ def connect(region, access_key_id):
         region_name=region, aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
     if not conn:
         raise Exception("invalid EC2 region ‘{0}’".format(region))
-    return conn
+    return rate_limited(conn, "ec2", region, access_key_id)
 
 def connect_vpc(region, access_key_id):
     """Connect to the specified VPC region using the given access key."""
@@ -77,7 +86,7 @@ def connect_vpc(region, access_key_id):
         region_name=region, aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
     if not conn:
         raise Exception("invalid VPC region ‘{0}’".format(region))
-    return conn
+    return rate_limited(conn, "ec2", region, access_key_id)
 
 
 def get_access_key_id():
@@ -87,7 +96,9 @@ def get_access_key_id():
 def retry(f, error_codes=[], logger=None):
     """
         Retry function f up to 7 times. If error_codes argument is empty list, retry on all EC2 response errors,
-        otherwise, only on the specified error codes.
+        otherwise, only on the specified error codes.  Requests rejected because of the EC2 request rate are
+        retried up to 7 more times, after slowing down all requests that share the rate limit of the rejected
+        one (i.e. to the same service and region with the same access key).
     """
 
     def handle_exception(e):
@@ -98,25 +109,24 @@ def retry(f, error_codes=[], logger=None):
 
     i = 0
     num_retries = 7
+    max_retries = 2 * num_retries
     while i <= num_retries:
         i += 1
         next_sleep = 5 + random.random() * (2 ** i)
 
         try:
             return f()
-        except EC2ResponseError as e:
-            handle_exception(e)
-        except SQSError as e:
-            handle_exception(e)
         except BotoServerError as e:
-            if e.error_code == "RequestLimitExceeded":
+            # This includes EC2ResponseError and SQSError.
+            if e.error_code == "RequestLimitExceeded" and num_retries < max_retries:
                 num_retries += 1
+                nixops.rate_limit.throttled()
             else:
                 handle_exception(e)
         except Exception as e:
             raise e
 
-        time.sleep(next_sleep)
+        nixops.parallel.sleep(next_sleep)
 
 
 def get_volume_by_id(conn, volume_id, allow_missing=False):
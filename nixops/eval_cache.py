@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+# On-disk cache of the output of ‘nix-instantiate’ for the evaluation
+# of a deployment.  Entries are keyed by a hash of everything that the
+# evaluation depends on, as far as this can be determined without
+# evaluating: the command line, the Nix search path, the NixOps Nix
+# expressions, and the network expressions and the files they refer
+# to.
+
+import os
+import re
+import hashlib
+
+# Increase this if the contents of the cache entries change.
+version = 1
+
+max_entries = 100
+
+# Path literals in Nix expressions.  This also matches absolute paths
+# in strings, which just makes the key a bit more conservative.
+_path_literal = re.compile(r"(?<![\w.+/-])(\.{0,2}/[\w.+/-]+)")
+
+
+def get_cache_dir():
+    return os.environ.get("HOME", "") + "/.nixops/eval-cache"
+
+
+def _add_file(h, path, seen):
+    path = os.path.normpath(path)
+    if path in seen: return
+    seen.add(path)
+    if path.startswith("/nix/store/"):
+        h.update("store {0}\0".format(path))
+    elif os.path.isdir(path):
+        # The directory may be used to compute file names,
+        # e.g. ‘./hosts + "/${name}.nix"’.
+        h.update("dir {0}\0".format(path))
+        for entry in sorted(os.listdir(path)):
+            if entry.endswith(".nix"): _add_file(h, os.path.join(path, entry), seen)
+    elif not os.path.isfile(path):
+        h.update("missing {0}\0".format(path))
+    elif not path.endswith(".nix"):
+        st = os.stat(path)
+        h.update("file {0} {1} {2}\0".format(path, st.st_size, st.st_mtime))
+    else:
+        with open(path) as f: contents = f.read()
+        h.update("nix {0} {1}\0".format(path, hashlib.sha256(contents).hexdigest()))
+        for m in _path_literal.finditer(contents):
+            _add_file(h, os.path.join(os.path.dirname(path), m.group(1)), seen)
+
+
+def get_key(argv, exprs, search_path, expr_path):
+    """Return the cache key for running ‘argv’ to evaluate the network
+    expressions ‘exprs’, or None if the result can't be cached.  This
+    is the case if the Nix search path contains URLs or directories
+    outside of the Nix store (other than ‘expr_path’), since we can't
+    tell whether their contents have changed."""
+    h = hashlib.sha256()
+    h.update("version {0}\0".format(version))
+    for arg in argv: h.update("arg {0}\0".format(arg))
+
+    seen = set()
+    _add_file(h, expr_path, seen)
+
+    entries = search_path + [e for e in os.environ.get("NIX_PATH", "").split(":") if e]
+    h.update("NIX_PATH {0}\0".format(os.environ.get("NIX_PATH", "")))
+    for entry in entries:
+        path = entry.split("=", 1)[-1]
+        if path.startswith("http://") or path.startswith("https://"):
+            return None
+        path = os.path.realpath(path)
+        if os.path.normpath(path) in seen: continue
+        if not path.startswith("/nix/store/"):
+            return None
+        h.update("search {0} {1}\0".format(entry, path))
+
+    for expr in exprs:
+        if expr.startswith("<"): continue
+        _add_file(h, expr, seen)
+
+    return h.hexdigest()
+
+
+def get(key, suffix=".json"):
+    """Return the cached evaluation output for ‘key’, or None.  Other
+    kinds of entries (such as the path of an instantiated derivation)
+    can be stored under the same key with a different ‘suffix’."""
+    path = get_cache_dir() + "/" + key + suffix
+    try:
+        with open(path) as f: res = f.read()
+    except IOError:
+        return None
+    os.utime(path, None)
+    return res
+
+
+def put(key, output, suffix=".json"):
+    """Store the evaluation output for ‘key’, and remove the least
+    recently used entries if there are too many."""
+    cache_dir = get_cache_dir()
+    if not os.path.exists(cache_dir): os.makedirs(cache_dir, 0700)
+    path = cache_dir + "/" + key + suffix
+    tmp = "{0}.tmp-{1}".format(path, os.getpid())
+    with open(tmp, "w") as f: f.write(output)
+    os.rename(tmp, path)
+
+    entries = [cache_dir + "/" + e for e in os.listdir(cache_dir) if e.endswith(suffix)]
+    if len(entries) > max_entries:
+        entries.sort(key=lambda e: os.path.getmtime(e))
+        for e in entries[:len(entries) - max_entries]:
+            try:
+                os.remove(e)
+            except OSError:
+                pass
@@ -5,6 +5,7 @@ import re
 
 from nixops.util import attr_property
 import nixops.resources
+import nixops.rate_limit
 
 from libcloud.compute.types import Provider
 from libcloud.compute.providers import get_driver
@@ -95,6 +96,8 @@ class ResourceState(nixops.resources.ResourceState):
     def connect(self):
         if not self._conn:
             self._conn = get_driver(Provider.GCE)(self.service_account, self.access_key_path, project = self.project)
+            nixops.rate_limit.limit_method(self._conn.connection, "request",
+                                           nixops.rate_limit.get_bucket("gce", self.project, self.service_account))
         return self._conn
 
     @property
@@ -3,8 +3,8 @@ import string
 
 from textwrap import dedent
 
-__all__ = ['py2nix', 'nix2py', 'nixmerge', 'expand_dict',
-           'RawValue', 'Function']
+__all__ = ['py2nix', 'py2nix_attrs', 'py2nix_let', 'nix2py', 'nixmerge', 'NixMergeBuilder',
+           'expand_dict', 'RawValue', 'Function']
 
 
 class RawValue(object):
@@ -20,6 +20,9 @@ class RawValue(object):
     def indent(self, level=0, inline=False, maxwidth=80):
         return "  " * level + self.value
 
+    def write(self, write, level=0, inline=False, maxwidth=80):
+        write(self.indent(level, inline, maxwidth))
+
     def __repr__(self):
         return self.value
 
@@ -40,6 +43,10 @@ class MultiLineRawValue(RawValue):
     def indent(self, level=0, inline=False, maxwidth=80):
         return '\n'.join(["  " * level + value for value in self.values])
 
+    def __eq__(self, other):
+        return (isinstance(other, MultiLineRawValue)
+                and other.values == self.values)
+
 
 class Function(object):
     def __init__(self, head, body):
@@ -64,7 +71,7 @@ class Call(object):
         return "{0} {1}".format(self.fun, self.arg)
 
     def __eq__(self, other):
-        return (isinstance(other, App)
+        return (isinstance(other, Call)
                 and other.fun == self.fun
                 and other.arg == self.arg)
 
@@ -75,38 +82,59 @@ class Container(object):
         self.children = children
         self.suffix = suffix
         self.inline_variant = inline_variant
+        self._min_length = None
+        self._inlineable = None
 
     def get_min_length(self):
         """
         Return the minimum length of this container and all sub-containers.
         """
-        return (len(self.prefix) + len(self.suffix) + 1 + len(self.children) +
+        if self._min_length is None:
+            self._min_length = (
+                len(self.prefix) + len(self.suffix) + 1 + len(self.children) +
                 sum([child.get_min_length() for child in self.children]))
+        return self._min_length
 
     def is_inlineable(self):
-        return all([child.is_inlineable() for child in self.children])
+        if self._inlineable is None:
+            self._inlineable = all([child.is_inlineable()
+                                    for child in self.children])
+        return self._inlineable
 
     def indent(self, level=0, inline=False, maxwidth=80):
+        chunks = []
+        self.write(chunks.append, level=level, inline=inline,
+                   maxwidth=maxwidth)
+        return ''.join(chunks)
+
+    def write(self, write, level=0, inline=False, maxwidth=80):
+        """
+        Like indent(), but pass the output in pieces to the function 'write'
+        rather than returning it.
+        """
         if not self.is_inlineable():
             inline = False
         elif level * 2 + self.get_min_length() < maxwidth:
             inline = True
         ind = "  " * level
         if inline and self.inline_variant is not None:
-            return self.inline_variant.indent(level=level, inline=True,
-                                              maxwidth=maxwidth)
+            self.inline_variant.write(write, level=level, inline=True,
+                                      maxwidth=maxwidth)
         elif inline:
-            sep = ' '
-            lines = ' '.join([child.indent(level=0, inline=True)
-                              for child in self.children])
-            suffix_ind = ""
+            write(ind + self.prefix + ' ')
+            for n, child in enumerate(self.children):
+                if n > 0:
+                    write(' ')
+                child.write(write, level=0, inline=True)
+            write(' ' + self.suffix)
         else:
-            sep = '\n'
-            lines = '\n'.join([child.indent(level + 1, inline=inline,
-                                            maxwidth=maxwidth)
-                               for child in self.children])
-            suffix_ind = ind
-        return ind + self.prefix + sep + lines + sep + suffix_ind + self.suffix
+            write(ind + self.prefix + '\n')
+            for n, child in enumerate(self.children):
+                if n > 0:
+                    write('\n')
+                child.write(write, level=level + 1, inline=inline,
+                            maxwidth=maxwidth)
+            write('\n' + ind + self.suffix)
 
 
 def enclose_node(node, prefix="", suffix=""):
@@ -141,6 +169,39 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
     if you want to break on every occasion possible. If 'inline' is set to
     True, squash everything into a single line.
     """
+    return _encode(value).indent(initial_indentation, maxwidth=maxwidth,
+                                 inline=inline)
+
+
+def py2nix_attrs(value, maxwidth=80):
+    """
+    Return the attributes of the dict 'value' as a list of Nix attribute
+    bindings, rendered as in py2nix(value) when that doesn't fit on a single
+    line. Wrapped in braces, the bindings of several dicts with distinct
+    attribute paths form an attribute set that merges them.
+    """
+    node = _encode(value)
+    if not isinstance(node, Container):
+        return []
+    return [child.indent(1, maxwidth=maxwidth) for child in node.children]
+
+
+def py2nix_let(value, maxwidth=80):
+    """
+    Return the head of a let expression that binds the attributes of the dict
+    'value', i.e. 'let ... in', to be followed by the body of the expression.
+    """
+    bindings = py2nix_attrs(value, maxwidth=maxwidth)
+    if not bindings:
+        return "let in"
+    return "let\n" + "\n".join(bindings) + "\nin"
+
+
+def _encode(value):
+    """
+    Return the layout tree of the given value, to be rendered by py2nix() or
+    py2nix_attrs().
+    """
     def _enc_int(node):
         if node < 0:
             return RawValue("builtins.sub 0 " + str(-node))
@@ -208,7 +269,11 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
                 child_key, child_value = child_value.items()[0]
                 encoded_key += "." + _enc_key(child_key)
 
-            contents = _enc(child_value)
+            # The values of an expanded dict are expanded already.
+            if isinstance(child_value, dict):
+                contents = _enc_attrset(child_value)
+            else:
+                contents = _enc(child_value)
             prefix = "{0} = ".format(encoded_key)
             suffix = ";"
 
@@ -256,8 +321,7 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
         else:
             raise ValueError("unable to encode {0}".format(repr(node)))
 
-    return _enc(value).indent(initial_indentation, maxwidth=maxwidth,
-                              inline=inline)
+    return _enc(value)
 
 
 def expand_dict(unexpanded):
@@ -287,36 +351,86 @@ def expand_dict(unexpanded):
         else:
             strings[key] = val
 
+    merged = NixMergeBuilder(paths + [strings]).get()
     return {key: (expand_dict(val) if isinstance(val, dict) else val)
-            for key, val in reduce(nixmerge, paths + [strings]).iteritems()}
+            for key, val in merged.iteritems()}
 
 
-def nixmerge(expr1, expr2):
+class NixMergeBuilder(object):
     """
-    Merge both expressions into one, merging dictionary keys and appending list
-    elements if they otherwise would clash.
+    Merge expressions into one like nixmerge(), but in a single pass over all
+    of them rather than pairwise. The merged value is built in place from
+    copies of the dictionaries and lists of the expressions, which are left
+    untouched. Merged lists keep their elements in the order they first
+    appear in, so the result only depends on the order of the expressions.
     """
-    def _merge_dicts(d1, d2):
-        out = {}
-        for key in set(d1.keys()).union(d2.keys()):
-            if key in d1 and key in d2:
-                out[key] = _merge(d1[key], d2[key])
-            elif key in d1:
-                out[key] = d1[key]
-            else:
-                out[key] = d2[key]
-        return out
+    def __init__(self, exprs=[]):
+        self._value = None
+        self._empty = True
+        # Elements of the merged lists, by id() of the list.
+        self._list_elems = {}
+        for expr in exprs:
+            self.add(expr)
+
+    def add(self, expr):
+        """
+        Merge 'expr' into the result.
+        """
+        if self._empty:
+            self._value = self._copy(expr)
+            self._empty = False
+        else:
+            self._value = self._merge(self._value, expr)
+
+    def get(self, default=None):
+        """
+        Return the merged expression, or 'default' if nothing was added.
+        """
+        return default if self._empty else self._value
+
+    def _copy(self, expr):
+        if isinstance(expr, dict):
+            return {key: self._copy(val) for key, val in expr.iteritems()}
+        elif isinstance(expr, list):
+            return list(expr)
+        else:
+            return expr
 
-    def _merge(e1, e2):
+    def _merge(self, e1, e2):
         if isinstance(e1, dict) and isinstance(e2, dict):
-            return _merge_dicts(e1, e2)
+            for key, val in e2.iteritems():
+                if key in e1:
+                    e1[key] = self._merge(e1[key], val)
+                else:
+                    e1[key] = self._copy(val)
+            return e1
         elif isinstance(e1, list) and isinstance(e2, list):
-            return list(set(e1).union(e2))
+            elems = self._list_elems.get(id(e1))
+            if elems is None:
+                elems = set()
+                unique = []
+                for elem in e1:
+                    if elem not in elems:
+                        elems.add(elem)
+                        unique.append(elem)
+                e1[:] = unique
+                self._list_elems[id(e1)] = elems
+            for elem in e2:
+                if elem not in elems:
+                    elems.add(elem)
+                    e1.append(elem)
+            return e1
         else:
             err = "unable to merge {0} with {1}".format(type(e1), type(e2))
             raise ValueError(err)
 
-    return _merge(expr1, expr2)
+
+def nixmerge(expr1, expr2):
+    """
+    Merge both expressions into one, merging dictionary keys and appending list
+    elements if they otherwise would clash.
+    """
+    return NixMergeBuilder([expr1, expr2]).get()
 
 
 def nix2py(source):
@@ -1,5 +1,8 @@
+# -*- coding: utf-8 -*-
+
 import threading
 import sys
+import time
 import Queue
 import random
 import traceback
@@ -17,54 +20,330 @@ class MultipleExceptions(Exception):
             traceback.print_exception(e[0], e[1], e[2])
 
 
+class Cancelled(Exception):
+    """Raised in a task when the work that it is part of has been
+    cancelled."""
+    pass
+
+
+class CancellationToken(object):
+    """A flag used to cancel outstanding work.  Tasks can check it
+    during long waits through check() and sleep().  A token is also
+    cancelled when its parent is."""
+
+    def __init__(self, parent=None):
+        self._event = threading.Event()
+        self._parent = parent
+
+    def cancel(self):
+        self._event.set()
+
+    def is_cancelled(self):
+        return self._event.is_set() or (self._parent is not None and self._parent.is_cancelled())
+
+    def check(self):
+        """Raise Cancelled if the work has been cancelled."""
+        if self.is_cancelled(): raise Cancelled()
+
+    def sleep(self, secs):
+        """Sleep for ‘secs’ seconds, raising Cancelled as soon as the
+        work is cancelled."""
+        deadline = time.time() + secs
+        while True:
+            self.check()
+            remaining = deadline - time.time()
+            if remaining <= 0: return
+            # Wake up regularly to notice the parent being cancelled.
+            self._event.wait(min(remaining, 1))
+
+
+_local = threading.local()
+
+
+def current_token():
+    """Return the cancellation token of the task running in the
+    current thread, or None."""
+    return getattr(_local, 'token', None)
+
+
+def check_cancelled():
+    """Raise Cancelled if the task running in the current thread has
+    been cancelled."""
+    token = current_token()
+    if token: token.check()
+
+
+def sleep(secs):
+    """Like time.sleep(), but raise Cancelled if the task running in
+    the current thread is cancelled in the meantime."""
+    token = current_token()
+    if token: token.sleep(secs)
+    else: time.sleep(secs)
+
+
+def _get(queue):
+    # Use a timeout to allow keyboard interrupts to be processed.
+    # The actual timeout value doesn't matter.
+    while True:
+        try:
+            return queue.get(True, 1000)
+        except Queue.Empty:
+            continue
+
+
+class Executor(object):
+    """A pool of worker threads shared by successive calls.  Threads
+    are started when needed and are kept for later calls."""
+
+    def __init__(self):
+        self._jobs = Queue.Queue()
+        self._lock = threading.Lock()
+        self._idle = 0
+
+    def _thread_fun(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                job()
+            finally:
+                with self._lock: self._idle += 1
+
+    def spawn(self, nr_threads, fun):
+        """Run ‘fun’ on ‘nr_threads’ threads concurrently.  Note that
+        ‘fun’ must not raise exceptions."""
+        with self._lock:
+            nr_reused = min(self._idle, nr_threads)
+            self._idle -= nr_reused
+        for n in range(nr_threads - nr_reused):
+            thr = threading.Thread(target=self._thread_fun)
+            thr.daemon = True
+            thr.start()
+        for n in range(nr_threads): self._jobs.put(fun)
+
+    def imap_unordered(self, worker_fun, tasks, nr_workers=-1, fail_fast=False,
+                       token=None, progress=None):
+        """Run ‘worker_fun’ on each task in ‘tasks’ using at most
+        ‘nr_workers’ threads (-1 meaning one per task), and yield
+        (task, result) pairs as the tasks finish.  ‘progress(task,
+        nr_done, nr_tasks)’ is called after each task.  Exceptions are
+        raised after all tasks have finished (as a MultipleExceptions
+        if there are several), or, if ‘fail_fast’ is set, as soon as
+        the running tasks have noticed the cancellation of the others.
+        The work is cancelled through ‘token’, which defaults to a
+        child of the token of the current task, and when the caller
+        stops iterating (e.g. on a keyboard interrupt)."""
+        tasks = list(tasks)
+        nr_tasks = len(tasks)
+        if nr_tasks == 0: return
+
+        if nr_workers == -1: nr_workers = nr_tasks
+        if nr_workers < 1: raise Exception("number of worker threads must be at least 1")
+        nr_workers = min(nr_workers, nr_tasks)
+
+        token = token or CancellationToken(current_token())
+        task_queue = Queue.Queue()
+        for t in tasks: task_queue.put(t)
+        result_queue = Queue.Queue()
+
+        def runner():
+            _local.token = token
+            try:
+                while not token.is_cancelled():
+                    try:
+                        t = task_queue.get(False)
+                    except Queue.Empty:
+                        break
+                    try:
+                        result_queue.put((t, worker_fun(t), None))
+                    except Exception as e:
+                        result_queue.put((t, None, sys.exc_info()))
+            finally:
+                _local.token = None
+                result_queue.put(None)
+
+        self.spawn(nr_workers, runner)
+
+        exceptions = []
+        nr_running = nr_workers
+        nr_done = 0
+        nr_succeeded = 0
+        try:
+            while nr_running > 0:
+                res = _get(result_queue)
+                if res is None:
+                    nr_running -= 1
+                    continue
+                (t, res, excinfo) = res
+                nr_done += 1
+                if progress: progress(t, nr_done, nr_tasks)
+                if excinfo:
+                    if not (issubclass(excinfo[0], Cancelled) and token.is_cancelled()):
+                        exceptions.append(excinfo)
+                    if fail_fast: token.cancel()
+                else:
+                    nr_succeeded += 1
+                    yield (t, res)
+        finally:
+            if nr_running > 0: token.cancel()
+
+        if len(exceptions) == 1:
+            excinfo = exceptions[0]
+            raise excinfo[0], excinfo[1], excinfo[2]
+
+        if len(exceptions) > 1:
+            raise MultipleExceptions(exceptions)
+
+        # Some tasks were cancelled or never started.
+        if nr_succeeded < nr_tasks: raise Cancelled()
+
+
+executor = Executor()
+
+
 def run_tasks(nr_workers, tasks, worker_fun):
-    task_queue = Queue.Queue()
-    result_queue = Queue.Queue()
+    """Run ‘worker_fun’ on each task in ‘tasks’ using at most
+    ‘nr_workers’ threads, and return the results in the order in
+    which the tasks finished.  See Executor.imap_unordered()."""
+    return [res for (t, res) in executor.imap_unordered(worker_fun, tasks, nr_workers)]
+
+
+class DependencyCycle(Exception):
+    pass
+
+
+def _task_name(t):
+    return getattr(t, "name", str(t))
+
+
+def _find_cycle(deps, remaining):
+    """Return a list of task indices forming a cycle among the tasks in
+    ‘remaining’, all of which are part of or depend on a cycle."""
+    n = next(iter(remaining))
+    path = []
+    on_path = {}
+    while n not in on_path:
+        on_path[n] = len(path)
+        path.append(n)
+        n = next(d for d in deps[n] if d in remaining)
+    return path[on_path[n]:] + [n]
 
-    nr_tasks = 0
-    for t in tasks: task_queue.put(t); nr_tasks = nr_tasks + 1
 
+def run_dag(nr_workers, tasks, dependencies, worker_fun, duration=None, token=None):
+    """Run ‘worker_fun’ on each task in ‘tasks’ using at most
+    ‘nr_workers’ threads, starting a task only once all tasks in
+    ‘dependencies(task)’ have finished.  Dependencies that are not in
+    ‘tasks’ are ignored.  Tasks that (transitively) depend on a task
+    that failed are skipped.  Raise DependencyCycle if the
+    dependencies contain a cycle.  Otherwise, return and raise like
+    run_tasks().
+
+    Of the tasks that are ready to run, the one with the longest
+    chain of work depending on it is started first, where
+    ‘duration(task)’ is the expected running time of a task (1 by
+    default).  Tasks that have not started yet when ‘token’ is
+    cancelled fail with Cancelled."""
+    tasks = list(tasks)
+    nr_tasks = len(tasks)
     if nr_tasks == 0: return []
 
     if nr_workers == -1: nr_workers = nr_tasks
     if nr_workers < 1: raise Exception("number of worker threads must be at least 1")
+    nr_workers = min(nr_workers, nr_tasks)
 
-    def thread_fun():
-        n = 0
-        while True:
-            try:
-                t = task_queue.get(False)
-            except Queue.Empty:
-                break
-            n = n + 1
-            try:
-                result_queue.put((worker_fun(t), None))
-            except Exception as e:
-                result_queue.put((None, sys.exc_info()))
-        #sys.stderr.write("thread {0} did {1} tasks\n".format(threading.current_thread(), n))
-
-    threads = []
-    for n in range(nr_workers):
-        thr = threading.Thread(target=thread_fun)
-        thr.daemon = True
-        thr.start()
-        threads.append(thr)
-
-    results = []
-    exceptions = []
-    while len(results) < nr_tasks:
+    index = {id(t): n for n, t in enumerate(tasks)}
+    deps = [set(index[id(d)] for d in dependencies(t) if id(d) in index) for t in tasks]
+    dependents = [[] for t in tasks]
+    for n, ds in enumerate(deps):
+        for d in ds: dependents[d].append(n)
+    pending = [len(ds) for ds in deps]
+
+    # Check for cycles before starting anything.
+    left = list(pending)
+    queue = [n for n in range(nr_tasks) if left[n] == 0]
+    order = []
+    while queue:
+        n = queue.pop()
+        order.append(n)
+        for d in dependents[n]:
+            left[d] -= 1
+            if left[d] == 0: queue.append(d)
+    if len(order) < nr_tasks:
+        cycle = _find_cycle(deps, set(n for n in range(nr_tasks) if left[n] > 0))
+        raise DependencyCycle("dependency cycle: " + " -> ".join(
+            "‘{0}’".format(_task_name(tasks[n])) for n in cycle))
+
+    # Compute the length of the critical path starting at each task,
+    # i.e. the longest chain of work that can't start before the task
+    # has finished.
+    path_length = [0] * nr_tasks
+    for n in reversed(order):
+        path_length[n] = (duration(tasks[n]) if duration else 1) + \
+            max([path_length[d] for d in dependents[n]] or [0])
+
+    token = token or CancellationToken(current_token())
+    ready_queue = Queue.PriorityQueue()
+    result_queue = Queue.Queue()
+    lock = threading.Lock()
+    failed = [False] * nr_tasks
+
+    def finish(n, res, excinfo):
+        # Release the dependents of this task before picking the next
+        # one, so that they compete with the tasks that are already
+        # ready.  Those of a failed task are finished right away
+        # without running them.
+        with lock:
+            failed[n] = excinfo is not None
+            result_queue.put((n, res, excinfo))
+            finished = [n]
+            while finished:
+                m = finished.pop()
+                for d in dependents[m]:
+                    failed[d] = failed[d] or failed[m]
+                    pending[d] -= 1
+                    if pending[d] == 0:
+                        if not failed[d]:
+                            ready_queue.put((-path_length[d], d))
+                        else:
+                            result_queue.put((d, None, None))
+                            finished.append(d)
+
+    def runner():
+        _local.token = token
         try:
-            # Use a timeout to allow keyboard interrupts to be
-            # processed.  The actual timeout value doesn't matter.
-            (res, excinfo) = result_queue.get(True, 1000)
-        except Queue.Empty:
-            continue
-        if excinfo:
-            exceptions.append(excinfo)
-        results.append(res)
+            while True:
+                (prio, n) = ready_queue.get()
+                if n is None: break
+                try:
+                    token.check()
+                    res = worker_fun(tasks[n])
+                except Exception as e:
+                    finish(n, None, sys.exc_info())
+                else:
+                    finish(n, res, None)
+        finally:
+            _local.token = None
+
+    # Queue the initial tasks before starting the runners, so that
+    # the first runner doesn't grab a task before the more urgent
+    # ones are queued.
+    for n in range(nr_tasks):
+        if pending[n] == 0: ready_queue.put((-path_length[n], n))
 
-    for thr in threads:
-        thr.join()
+    executor.spawn(nr_workers, runner)
+
+    results = [None] * nr_tasks
+    exceptions = []
+    try:
+        for nr_done in range(nr_tasks):
+            (n, res, excinfo) = _get(result_queue)
+            results[n] = res
+            if excinfo: exceptions.append(excinfo)
+    except:
+        token.cancel()
+        raise
+    finally:
+        for n in range(nr_workers):
+            ready_queue.put((float("inf"), None))
 
     if len(exceptions) == 1:
         excinfo = exceptions[0]
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# Process-wide limits on the rate and concurrency of cloud provider
+# API calls.  All threads share one token bucket per provider, region
+# and credential, so that a large deployment stays below the
+# provider's throttling thresholds instead of running into rejected
+# requests and retries.
+
+import os
+import time
+import threading
+
+# The sustained number of requests per second, the burst size and the
+# maximum number of requests in progress at the same time allowed for
+# each provider.  These can be overridden through
+# $NIXOPS_API_RATE_LIMITS, e.g. ‘ec2=20:100:10,gce=5’.
+default_limits = {
+    "ec2": (10.0, 50, 20),
+    "gce": (10.0, 20, 10),
+    "azure": (5.0, 20, 20),
+    "azure-storage": (20.0, 50, 20),
+    "datadog": (2.0, 10, 4),
+    "digitalocean": (1.3, 50, 10),
+}
+
+default_limit = (10.0, 20, 10)
+
+_lock = threading.Lock()
+_buckets = {}
+_limits = None
+
+# The bucket of the last call made by each thread (see throttled()).
+_local = threading.local()
+
+
+class TokenBucket(object):
+    """Allow on average ‘rate’ calls per second, with bursts of up to
+    ‘burst’ calls.  If ‘concurrency’ is given, calls made through
+    call() additionally wait while that many are in progress."""
+
+    def __init__(self, rate, burst, concurrency=None):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(concurrency) if concurrency else None
+
+    def acquire(self):
+        """Wait until a call is allowed."""
+        _local.bucket = self
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Take the token now, even if it is not there yet, so
+            # that waiting callers are served in order.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0: time.sleep(wait)
+
+    def call(self, fun, *args, **kwargs):
+        """Call ‘fun’ once a call is allowed, and hold one of the
+        ‘concurrency’ slots until it returns."""
+        if self._slots: self._slots.acquire()
+        try:
+            self.acquire()
+            return fun(*args, **kwargs)
+        finally:
+            if self._slots: self._slots.release()
+
+    def throttled(self):
+        """Called when the provider rejected a call because of its
+        rate; drop the accumulated burst so that the following calls
+        are spread out at the sustained rate."""
+        with self._lock:
+            self._tokens = min(self._tokens, 0)
+
+
+def _parse_limits(s):
+    limits = {}
+    for entry in s.replace(",", " ").split():
+        try:
+            (provider, limit) = entry.split("=", 1)
+            (rate, burst, concurrency) = (limit.split(":", 2) + [None, None])[:3]
+            rate = float(rate)
+            burst = int(burst) if burst is not None else max(1, int(rate))
+            concurrency = int(concurrency) if concurrency is not None else None
+        except ValueError:
+            raise Exception("invalid entry ‘{0}’ in $NIXOPS_API_RATE_LIMITS".format(entry))
+        if rate <= 0 or burst < 1 or (concurrency is not None and concurrency < 1):
+            raise Exception("invalid entry ‘{0}’ in $NIXOPS_API_RATE_LIMITS".format(entry))
+        limits[provider] = (rate, burst, concurrency)
+    return limits
+
+
+def get_limit(provider):
+    """Return the (rate, burst, concurrency) limit for ‘provider’."""
+    global _limits
+    if _limits is None:
+        limits = dict(default_limits)
+        for p, (rate, burst, concurrency) in _parse_limits(os.environ.get("NIXOPS_API_RATE_LIMITS", "")).iteritems():
+            if concurrency is None: concurrency = limits.get(p, default_limit)[2]
+            limits[p] = (rate, burst, concurrency)
+        _limits = limits
+    return _limits.get(provider, default_limit)
+
+
+def get_bucket(provider, region=None, credential=None):
+    """Return the token bucket shared by all calls to ‘provider’ in
+    ‘region’ with ‘credential’."""
+    key = (provider, region, credential)
+    with _lock:
+        bucket = _buckets.get(key)
+        if not bucket:
+            (rate, burst, concurrency) = get_limit(provider)
+            bucket = _buckets[key] = TokenBucket(rate, burst, concurrency)
+        return bucket
+
+
+def throttled():
+    """Slow down the calls that share a bucket with the last call
+    made by this thread, after the provider rejected that call because
+    of its rate."""
+    bucket = getattr(_local, "bucket", None)
+    if bucket: bucket.throttled()
+
+
+class RateLimited(object):
+    """A proxy for an API client object that makes each method call on
+    the object or on its attributes (such as
+    ‘client.resource_groups.create_or_update(...)’) through
+    ‘bucket’."""
+
+    def __init__(self, obj, bucket):
+        self._obj = obj
+        self._bucket = bucket
+
+    def __getattr__(self, name):
+        value = getattr(self._obj, name)
+        if isinstance(value, (basestring, int, long, float, bool, type(None), list, dict, tuple)):
+            return value
+        return RateLimited(value, self._bucket)
+
+    def __call__(self, *args, **kwargs):
+        return self._bucket.call(self._obj, *args, **kwargs)
+
+
+def limit_method(obj, name, bucket):
+    """Make the calls to the method ‘name’ of ‘obj’ go through
+    ‘bucket’."""
+    method = getattr(obj, name)
+    def limited(*args, **kwargs):
+        return bucket.call(method, *args, **kwargs)
+    setattr(obj, name, limited)
+    return obj
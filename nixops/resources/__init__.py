@@ -59,19 +59,34 @@ class ResourceState(object):
         self.depl = depl
         self.name = name
         self.id = id
+        self._attr_journal = None
         self.logger = depl.logger.get_logger_for(name)
         self.logger.register_index(self.index)
 
     def _set_attrs(self, attrs):
         """Update machine attributes in the state file."""
+        if self._attr_journal is not None:
+            # Hold the lock so that the cache isn't reloaded meanwhile.
+            with self.depl._db:
+                cache = self.depl._resource_attrs[self.id]
+                for n, v in attrs.iteritems():
+                    self._attr_journal[n] = v
+                    if v == None:
+                        cache.pop(n, None)
+                    else:
+                        cache[n] = nixops.util.db_text(v)
+            return
         with self.depl._db:
             c = self.depl._db.cursor()
+            cache = self.depl._resource_attrs[self.id]
             for n, v in attrs.iteritems():
                 if v == None:
                     c.execute("delete from ResourceAttrs where machine = ? and name = ?", (self.id, n))
+                    cache.pop(n, None)
                 else:
                     c.execute("insert or replace into ResourceAttrs(machine, name, value) values (?, ?, ?)",
                               (self.id, n, v))
+                    cache[n] = nixops.util.db_text(v)
 
     def _set_attr(self, name, value):
         """Update one machine attribute in the state file."""
@@ -79,17 +94,35 @@ class ResourceState(object):
 
     def _del_attr(self, name):
         """Delete a machine attribute from the state file."""
+        if self._attr_journal is not None:
+            self._set_attrs({name: None})
+            return
         with self.depl._db:
             self.depl._db.execute("delete from ResourceAttrs where machine = ? and name = ?", (self.id, name))
+            self.depl._resource_attrs[self.id].pop(name, None)
+
+    def _start_attr_journal(self):
+        """Collect subsequent attribute writes in memory rather than
+        writing them to the state file one at a time.  Reads see the
+        journalled values immediately."""
+        if self._attr_journal is None:
+            self._attr_journal = {}
+
+    def _flush_attr_journal(self):
+        """Write the journalled attribute changes to the state file and
+        stop journalling.  This must be called inside a transaction."""
+        journal = self._attr_journal
+        if journal is None: return
+        self._attr_journal = None
+        c = self.depl._db.cursor()
+        c.executemany("delete from ResourceAttrs where machine = ? and name = ?",
+                      [(self.id, n) for n, v in journal.iteritems() if v == None])
+        c.executemany("insert or replace into ResourceAttrs(machine, name, value) values (?, ?, ?)",
+                      [(self.id, n, v) for n, v in journal.iteritems() if v != None])
 
     def _get_attr(self, name, default=nixops.util.undefined):
         """Get a machine attribute from the state file."""
-        with self.depl._db:
-            c = self.depl._db.cursor()
-            c.execute("select value from ResourceAttrs where machine = ? and name = ?", (self.id, name))
-            row = c.fetchone()
-            if row != None: return row[0]
-            return nixops.util.undefined
+        return self.depl._get_cached_attr(name, self.id)
 
     def export(self):
         """Export the resource to move between databases"""
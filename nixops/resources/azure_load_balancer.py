@@ -455,6 +455,31 @@ class AzureLoadBalancerState(ResourceState):
         from nixops.resources.azure_resource_group import AzureResourceGroupState
         from nixops.resources.azure_virtual_network import AzureVirtualNetworkState
         from nixops.resources.azure_reserved_ip_address import AzureReservedIPAddressState
-        return {r for r in resources
-                  if isinstance(r, AzureResourceGroupState) or isinstance(r, AzureVirtualNetworkState) or
-                     isinstance(r, AzureReservedIPAddressState) }
+        if defn is None:
+            return {r for r in resources
+                      if isinstance(r, AzureResourceGroupState) or isinstance(r, AzureVirtualNetworkState) or
+                         isinstance(r, AzureReservedIPAddressState) }
+
+        # Only depend on the resource group, virtual networks and
+        # reserved IP addresses referenced by this load balancer.
+        def key(group, name):
+            return (group or "").lower(), (name or "").lower()
+        refs = [ ResId(_if['subnet'] or _if['public_ip_address'])
+                 for _if in defn.frontend_interfaces.itervalues() ]
+        networks = {key(r_id.get('group'), r_id.get('resource'))
+                    for r_id in refs if r_id.get('type') == 'virtualNetworks'}
+        ips = {key(r_id.get('group'), r_id.get('resource'))
+               for r_id in refs if r_id.get('type') == 'publicIPAddresses'}
+
+        def referenced(r):
+            r_defn = self.depl.definitions.get(r.name)
+            if r_defn is None: return False
+            if isinstance(r, AzureResourceGroupState):
+                return key(r_defn.resource_group_name, None) == key(defn.resource_group, None)
+            if isinstance(r, AzureVirtualNetworkState):
+                return key(r_defn.resource_group, r_defn.network_name) in networks
+            if isinstance(r, AzureReservedIPAddressState):
+                return key(r_defn.resource_group, r_defn.reserved_ip_address_name) in ips
+            return False
+
+        return {r for r in resources if referenced(r)}
@@ -61,8 +61,9 @@ class CloudWatchLogStreamState(nixops.resources.ResourceState):
         if self._conn: return
         assert self.region
         (access_key_id, secret_access_key) = nixops.ec2_utils.fetch_aws_secret_key(self.access_key_id)
-        self._conn = boto.logs.connect_to_region(
-            region_name=self.region, aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
+        self._conn = nixops.ec2_utils.rate_limited(boto.logs.connect_to_region(
+            region_name=self.region, aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key),
+            "logs", self.region, access_key_id)
 
     def _destroy(self):
         if self.state != self.UP: return
@@ -93,10 +94,17 @@ class CloudWatchLogStreamState(nixops.resources.ResourceState):
         return False, None
 
     def create_after(self, resources, defn):
-        # FIXME can be improved to check that we only need to wait for
-        # the needed Log Groups to be created and not all Log Groups resources
+        # Only wait for the log group of this stream.  When destroying,
+        # there is no definition, so go by the recorded names instead.
+        # Log groups that were not evaluated (e.g. with ‘--include’)
+        # have no definition either, so wait for all of those.
+        def referenced(r):
+            if not defn: return r.log_group_name == self.log_group_name
+            r_defn = self.depl.definitions.get(r.name)
+            return r_defn is None or r_defn.config['name'] == defn.config['logGroupName']
         return {r for r in resources if
-                isinstance(r, nixops.resources.cloudwatch_log_group.CloudWatchLogGroupState)}
+                isinstance(r, nixops.resources.cloudwatch_log_group.CloudWatchLogGroupState) and
+                referenced(r)}
 
     def create(self, defn, check, allow_reboot, allow_recreate):
         self.access_key_id = defn.config['accessKeyId'] or nixops.ec2_utils.get_access_key_id()
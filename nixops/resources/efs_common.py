@@ -1,5 +1,6 @@
 import boto3
 import nixops.ec2_utils
+import nixops.rate_limit
 
 class EFSCommonState():
 
@@ -10,8 +11,10 @@ class EFSCommonState():
 
         (access_key_id, secret_access_key) = nixops.ec2_utils.fetch_aws_secret_key(access_key_id or self.access_key_id)
 
-        self._client = boto3.session.Session().client('efs', region_name=region or self.region, \
-                                                     aws_access_key_id=access_key_id, \
-                                                     aws_secret_access_key=secret_access_key)
+        self._client = nixops.rate_limit.RateLimited(
+            boto3.session.Session().client('efs', region_name=region or self.region, \
+                                           aws_access_key_id=access_key_id, \
+                                           aws_secret_access_key=secret_access_key),
+            nixops.rate_limit.get_bucket("efs", region or self.region, access_key_id))
 
         return self._client
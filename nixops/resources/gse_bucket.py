@@ -6,6 +6,7 @@ import os
 import re
 import libcloud.common.google
 
+import nixops.rate_limit
 from nixops.util import attr_property
 from nixops.gce_common import ResourceDefinition, ResourceState, optional_string, optional_int, optional_bool
 
@@ -143,6 +144,8 @@ class GSEBucketState(ResourceState):
     def connect(self):
         if not self._conn:
             self._conn = GSEConnection(self.service_account, self.access_key_path, True)
+            nixops.rate_limit.limit_method(self._conn, "request",
+                                           nixops.rate_limit.get_bucket("gse", None, self.service_account))
         return self._conn
 
     defn_properties = [ 'cors', 'lifecycle', 'log_bucket', 'log_object_prefix',
@@ -66,8 +66,9 @@ class SNSTopicState(nixops.resources.ResourceState):
         if self._conn: return
         assert self.region
         (access_key_id, secret_access_key) = nixops.ec2_utils.fetch_aws_secret_key(self.access_key_id)
-        self._conn = boto.sns.connect_to_region(
-            region_name=self.region, aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
+        self._conn = nixops.ec2_utils.rate_limited(boto.sns.connect_to_region(
+            region_name=self.region, aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key),
+            "sns", self.region, access_key_id)
 
     def _destroy(self):
         if self.state != self.UP: return
@@ -1,23 +1,30 @@
 # -*- coding: utf-8 -*-
 
 import nixops.deployment
+import itertools
 import os
 import os.path
 from pysqlite2 import dbapi2 as sqlite3
 import sys
 import threading
+import urllib
+import weakref
 
 
 class Connection(sqlite3.Connection):
 
     def __init__(self, db_file, **kwargs):
-        db_exists = os.path.exists(db_file)
+        db_exists = kwargs.get("uri", False) or os.path.exists(db_file)
         if not db_exists:
             os.fdopen(os.open(db_file, os.O_WRONLY | os.O_CREAT, 0o600), 'w').close()
         sqlite3.Connection.__init__(self, db_file, **kwargs)
         self.db_file = db_file
         self.nesting = 0
         self.lock = threading.RLock()
+        # Number of rolled back transactions; lets in-memory caches of
+        # the state file notice that they may be out of date.
+        self.rollbacks = 0
+        self.transaction_depth = 0
 
     # Implement Python's context management protocol so that "with db"
     # automatically commits or rolls back.  The difference with the
@@ -37,6 +44,7 @@ class Connection(sqlite3.Connection):
         assert self.nesting >= 0
         if self.nesting == 0:
             if self.must_rollback:
+                self.rollbacks = self.rollbacks + 1
                 try:
                     self.rollback()
                 except sqlite3.ProgrammingError:
@@ -46,6 +54,111 @@ class Connection(sqlite3.Connection):
         self.lock.release()
 
 
+class Transaction(object):
+    """Context manager that executes the enclosed statements in a
+    single SQLite transaction.  Since the connection is in autocommit
+    mode, the statements of a plain ‘with db’ block are committed one
+    by one; this commits them at once, which is much cheaper for bulk
+    writes.  It nests both in itself and in ‘with db’ blocks."""
+
+    def __init__(self, db):
+        self._db = db
+
+    def __enter__(self):
+        self._db.__enter__()
+        writer = self._db.writer
+        if writer.transaction_depth == 0:
+            writer.execute("begin")
+        writer.transaction_depth = writer.transaction_depth + 1
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        writer = self._db.writer
+        try:
+            writer.transaction_depth = writer.transaction_depth - 1
+            if writer.transaction_depth == 0:
+                if exception_type == None:
+                    writer.execute("commit")
+                else:
+                    writer.rollbacks = writer.rollbacks + 1
+                    writer.execute("rollback")
+        finally:
+            self._db.__exit__(exception_type, exception_value, exception_traceback)
+
+
+class ConnectionPool(object):
+    """Access to the state file from multiple threads.  All writes go
+    through a single Connection, which preserves its nesting ‘with’
+    semantics: statements executed inside a ‘with pool’ block use the
+    writer.  Statements executed outside such a block use a read-only
+    connection owned by the calling thread, so readers in different
+    threads neither wait for each other nor for the writer (the state
+    file is in WAL mode).
+
+    As a consequence, statements outside a ‘with pool’ block only see
+    committed data: they don't see the writes of a transaction that
+    another thread (or an enclosing Transaction of the calling thread)
+    has not committed yet.  Code that needs to read such writes must
+    do so inside a ‘with pool’ block."""
+
+    def __init__(self, writer, connect_reader):
+        self.writer = writer
+        self.db_file = writer.db_file
+        self._connect_reader = connect_reader
+        self._local = threading.local()
+        self._readers = []  # (weak reference to thread, reader)
+        self._readers_lock = threading.Lock()
+
+    @property
+    def rollbacks(self):
+        return self.writer.rollbacks
+
+    def __enter__(self):
+        self.writer.__enter__()
+        self._local.nesting = getattr(self._local, 'nesting', 0) + 1
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self._local.nesting = self._local.nesting - 1
+        self.writer.__exit__(exception_type, exception_value, exception_traceback)
+
+    def _get_reader(self):
+        reader = getattr(self._local, 'reader', None)
+        if reader is None:
+            reader = self._connect_reader()
+            with self._readers_lock:
+                # Close the readers of threads that have exited.
+                readers = []
+                for (thread, r) in self._readers:
+                    if thread() is not None and thread().is_alive():
+                        readers.append((thread, r))
+                    else:
+                        r.close()
+                readers.append((weakref.ref(threading.current_thread()), reader))
+                self._readers = readers
+            self._local.reader = reader
+        return reader
+
+    def _get_connection(self):
+        if getattr(self._local, 'nesting', 0) > 0:
+            return self.writer
+        return self._get_reader()
+
+    def cursor(self):
+        return self._get_connection().cursor()
+
+    def execute(self, *args):
+        return self._get_connection().execute(*args)
+
+    def executemany(self, *args):
+        return self._get_connection().executemany(*args)
+
+    def close(self):
+        with self._readers_lock:
+            for (thread, reader) in self._readers:
+                reader.close()
+            self._readers = []
+        self.writer.close()
+
+
 def get_default_state_file():
     home = os.environ.get("HOME", "") + "/.nixops"
     if not os.path.exists(home):
@@ -60,16 +173,41 @@ def get_default_state_file():
     return os.environ.get("NIXOPS_STATE", os.environ.get("CHARON_STATE", home + "/deployments.nixops"))
 
 
+class DeploymentSummary(object):
+    """Overview of a deployment, as shown by ‘nixops list’."""
+
+    def __init__(self, uuid, name, description, nr_machines, machine_types):
+        self.uuid = uuid
+        self.name = name
+        self.description = description
+        self.nr_machines = nr_machines
+        self.machine_types = machine_types
+
+
 class StateFile(object):
     """NixOps state file."""
 
-    current_schema = 3
+    current_schema = 4
 
-    def __init__(self, db_file):
+    def __init__(self, db_file, read_only=False):
         self.db_file = db_file
 
+        # The ShardedStateFile this state file is a shard of, if any.
+        self.catalog = None
+
         if os.path.splitext(db_file)[1] not in ['.nixops', '.charon']:
             raise Exception("state file ‘{0}’ should have extension ‘.nixops’".format(db_file))
+
+        # In read-only mode, fall back to a normal open if the state
+        # file doesn't exist yet or needs a schema upgrade.
+        self.read_only = False
+        if read_only and os.path.exists(db_file):
+            db = self._open_read_only(db_file)
+            if db:
+                self.read_only = True
+                self._db = ConnectionPool(db, self._connect_reader)
+                return
+
         db = sqlite3.connect(db_file, timeout=60, check_same_thread=False, factory=Connection, isolation_level=None) # FIXME
         db.db_file = db_file
 
@@ -96,11 +234,43 @@ class StateFile(object):
             elif version < self.current_schema:
                 if version <= 1: self._upgrade_1_to_2(c)
                 if version <= 2: self._upgrade_2_to_3(c)
+                if version <= 3: self._upgrade_3_to_4(c)
                 c.execute("update SchemaVersion set version = ?", (self.current_schema,))
             else:
                 raise Exception("this NixOps version is too old to deal with schema version {0}".format(version))
 
-        self._db = db
+        self._db = ConnectionPool(db, self._connect_reader)
+
+    def _open_read_only(self, db_file):
+        """Open the state file without writing to it, so that queries
+        don't contend with a concurrent ‘nixops deploy’.  Return None if
+        the state file has a different schema version."""
+        db = self._connect_read_only(db_file, Connection)
+        db.db_file = db_file
+
+        c = db.cursor()
+        version = None
+        if self._table_exists(c, 'SchemaVersion'):
+            c.execute("select version from SchemaVersion")
+            version = c.fetchone()[0]
+        if version != self.current_schema:
+            db.close()
+            return None
+        return db
+
+    @staticmethod
+    def _connect_read_only(db_file, factory):
+        kwargs = dict(timeout=60, check_same_thread=False, factory=factory, isolation_level=None)
+        try:
+            db = sqlite3.connect("file:" + urllib.quote(os.path.abspath(db_file)) + "?mode=ro", uri=True, **kwargs)
+        except TypeError:
+            # This version of pysqlite doesn't support URI filenames.
+            db = sqlite3.connect(db_file, **kwargs)
+            db.execute("pragma query_only = 1")
+        return db
+
+    def _connect_reader(self):
+        return self._connect_read_only(self.db_file, sqlite3.Connection)
 
     def close(self):
         self._db.close()
@@ -123,12 +293,70 @@ class StateFile(object):
                 sys.stderr.write("skipping deployment ‘{0}’: {1}\n".format(uuid, str(e)))
         return res
 
+    def get_deployment_summaries(self):
+        """Return a DeploymentSummary for every deployment in the
+        database.  Unlike get_all_deployments(), this does not create
+        any Deployment or resource state objects."""
+        types = nixops.deployment.machine_types()
+        c = self._db.cursor()
+        c.execute("select d.uuid, d.name, " +
+                  "(select value from DeploymentAttrs where deployment = d.uuid and name = 'description'), " +
+                  "count(r.id), group_concat(distinct r.type) " +
+                  "from Deployments d left join Resources r on r.deployment = d.uuid and r.type in ({0}) ".format(", ".join(["?"] * len(types))) +
+                  "group by d.uuid", types)
+        return [DeploymentSummary(uuid, name, description or nixops.deployment.Deployment.default_description,
+                                  nr_machines, sorted(machine_types.split(",")) if machine_types else [])
+                for (uuid, name, description, nr_machines, machine_types) in c.fetchall()]
+
+    def export_records(self, uuid):
+        """Yield the state of the deployment with the given UUID as a
+        stream of records: one with the deployment attributes, followed
+        by one per resource.  Only one resource is held in memory at a
+        time."""
+        c = self._db.cursor()
+        c.execute("select name, value from DeploymentAttrs where deployment = ?", (uuid,))
+        yield {'uuid': uuid, 'attrs': dict(c.fetchall())}
+        c.execute("select r.id, r.name, r.type, a.name, a.value from Resources r " +
+                  "left join ResourceAttrs a on a.machine = r.id where r.deployment = ? order by r.id", (uuid,))
+        for (id, name, type), rows in itertools.groupby(c, lambda row: row[:3]):
+            yield {'uuid': uuid, 'resource': name, 'type': type,
+                   'attrs': {n: v for (_, _, _, n, v) in rows if n is not None}}
+
+    def import_records(self, records):
+        """Create deployments from a stream of records as produced by
+        export_records(), using bulk inserts in a single transaction.
+        Return the UUIDs of the new deployments."""
+        existing = set(self.query_deployments())
+        imported = []
+        with Transaction(self._db):
+            c = self._db.cursor()
+            for record in records:
+                uuid = record['uuid']
+                if 'resource' not in record:
+                    if uuid in existing:
+                        raise Exception("state file already contains a deployment with UUID ‘{0}’".format(uuid))
+                    existing.add(uuid)
+                    imported.append(uuid)
+                    c.execute("insert into Deployments(uuid) values (?)", (uuid,))
+                    c.executemany("insert into DeploymentAttrs(deployment, name, value) values (?, ?, ?)",
+                                  [(uuid, n, v) for n, v in record['attrs'].iteritems()])
+                else:
+                    if uuid not in imported:
+                        raise Exception("imported resource ‘{0}’ precedes its deployment ‘{1}’".format(record['resource'], uuid))
+                    if not record.get('type'): raise Exception("imported resource lacks a type")
+                    c.execute("insert into Resources(deployment, name, type) values (?, ?, ?)",
+                              (uuid, record['resource'], record['type']))
+                    id = c.lastrowid
+                    c.executemany("insert into ResourceAttrs(machine, name, value) values (?, ?, ?)",
+                                  [(id, n, v) for n, v in record['attrs'].iteritems()])
+        return imported
+
     def _find_deployment(self, uuid=None):
         c = self._db.cursor()
         if not uuid:
             c.execute("select uuid from Deployments")
         else:
-            c.execute("select uuid from Deployments d where uuid = ? or exists (select 1 from DeploymentAttrs where deployment = d.uuid and name = 'name' and value = ?)", (uuid, uuid))
+            c.execute("select uuid from Deployments where uuid = ? or name = ?", (uuid, uuid))
         res = c.fetchall()
         if len(res) == 0:
             if uuid:
@@ -144,7 +372,10 @@ class StateFile(object):
                 raise Exception("state file contains multiple deployments with the same name, so you should specify one using its UUID")
             else:
                 raise Exception("state file contains multiple deployments, so you should specify which one to use using ‘-d’, or set the environment variable NIXOPS_DEPLOYMENT")
-        return nixops.deployment.Deployment(self, res[0][0], sys.stderr)
+        return self._open_deployment(res[0][0])
+
+    def _open_deployment(self, uuid):
+        return nixops.deployment.Deployment(self, uuid, sys.stderr)
 
     def open_deployment(self, uuid=None):
         """Open an existing deployment."""
@@ -161,7 +392,16 @@ class StateFile(object):
             self._db.execute("insert into Deployments(uuid) values (?)", (uuid,))
         return nixops.deployment.Deployment(self, uuid, sys.stderr)
 
-    def _table_exists(self, c, table):
+    def _deployment_renamed(self, uuid, name):
+        """Called when the ‘name’ attribute of a deployment changes."""
+        if self.catalog: self.catalog._set_name(uuid, name)
+
+    def _deployment_deleted(self, uuid):
+        """Called after a deployment has been deleted."""
+        if self.catalog: self.catalog._delete_shard(uuid)
+
+    @staticmethod
+    def _table_exists(c, table):
         c.execute("select 1 from sqlite_master where name = ? and type='table'", (table,));
         return c.fetchone() != None
 
@@ -176,9 +416,12 @@ class StateFile(object):
     def _create_schema(self, c):
         self._create_schemaversion(c)
 
+        # Deployments.name is a copy of the ‘name’ deployment
+        # attribute, maintained by triggers (see _create_indexes).
         c.execute(
             '''create table if not exists Deployments(
-                 uuid text primary key
+                 uuid text primary key,
+                 name text
                );''')
 
         c.execute(
@@ -208,6 +451,36 @@ class StateFile(object):
                  foreign key(machine) references Resources(id) on delete cascade
                );''')
 
+        self._create_indexes(c)
+
+    def _create_indexes(self, c):
+        c.execute("create index if not exists DeploymentsByName on Deployments(name)")
+        c.execute("create index if not exists DeploymentAttrsByNameValue on DeploymentAttrs(name, value)")
+        c.execute("create index if not exists ResourcesByDeployment on Resources(deployment, name)")
+
+        # Keep Deployments.name in sync with the ‘name’ attribute.
+        c.execute(
+            '''create trigger if not exists DeploymentNameInsert
+                 after insert on DeploymentAttrs when new.name = 'name'
+               begin
+                 update Deployments set name = new.value where uuid = new.deployment;
+               end;''')
+
+        c.execute(
+            '''create trigger if not exists DeploymentNameUpdate
+                 after update on DeploymentAttrs when new.name = 'name' or old.name = 'name'
+               begin
+                 update Deployments set name = null where uuid = old.deployment and old.name = 'name';
+                 update Deployments set name = new.value where uuid = new.deployment and new.name = 'name';
+               end;''')
+
+        c.execute(
+            '''create trigger if not exists DeploymentNameDelete
+                 after delete on DeploymentAttrs when old.name = 'name'
+               begin
+                 update Deployments set name = null where uuid = old.deployment;
+               end;''')
+
     def _upgrade_1_to_2(self, c):
         sys.stderr.write("updating database schema from version 1 to 2...\n")
         self._create_schemaversion(c)
@@ -217,4 +490,174 @@ class StateFile(object):
         c.execute("alter table Machines rename to Resources")
         c.execute("alter table MachineAttrs rename to ResourceAttrs")
 
+    def _upgrade_3_to_4(self, c):
+        sys.stderr.write("updating database schema from version 3 to 4...\n")
+        c.execute("alter table Deployments add column name text")
+        c.execute("update Deployments set name = " +
+                  "(select a.value from DeploymentAttrs a where a.deployment = Deployments.uuid and a.name = 'name')")
+        self._create_indexes(c)
+
+
+class ShardedStateFile(StateFile):
+    """NixOps state stored as one SQLite database (a ‘shard’) per
+    deployment, plus a small catalog database that maps deployment
+    UUIDs and names to shards.  The catalog is only written when a
+    deployment is created, renamed or deleted, so a long-running
+    operation on one deployment doesn't hold up operations on other
+    deployments.  Each shard is an ordinary StateFile containing a
+    single deployment."""
+
+    current_catalog_schema = 1
+
+    def __init__(self, db_file, read_only=False, shard_dir=None):
+        self.db_file = db_file
+        self.catalog = None
+        self.read_only = read_only and os.path.exists(db_file)
+
+        if os.path.splitext(db_file)[1] not in ['.nixops', '.charon']:
+            raise Exception("state file ‘{0}’ should have extension ‘.nixops’".format(db_file))
+
+        # Shards are stored in a directory next to the catalog.
+        self.shard_dir = shard_dir or os.path.splitext(db_file)[0] + ".d"
+        self._shards = {}
+        self._shards_lock = threading.Lock()
+
+        if self.read_only:
+            db = self._connect_read_only(db_file, Connection)
+            db.db_file = db_file
+        else:
+            db = sqlite3.connect(db_file, timeout=60, check_same_thread=False, factory=Connection, isolation_level=None)
+            db.db_file = db_file
+            db.execute("pragma journal_mode = wal")
+
+        with db:
+            c = db.cursor()
+            version = 0
+            if self._table_exists(c, 'CatalogVersion'):
+                c.execute("select version from CatalogVersion")
+                version = c.fetchone()[0]
+            if version == 0 and not self.read_only:
+                self._create_catalog_schema(c)
+            elif version != self.current_catalog_schema:
+                raise Exception("this NixOps version cannot deal with state catalog version {0}".format(version))
+
+        self._db = ConnectionPool(db, self._connect_reader)
+
+    @classmethod
+    def is_catalog(cls, db_file):
+        """Return whether ‘db_file’ is the catalog of a sharded state."""
+        if not os.path.exists(db_file): return False
+        db = cls._connect_read_only(db_file, sqlite3.Connection)
+        try:
+            return cls._table_exists(db.cursor(), 'CatalogVersion')
+        finally:
+            db.close()
+
+    def _create_catalog_schema(self, c):
+        c.execute(
+            '''create table if not exists CatalogVersion(
+                 version integer not null
+               );''')
+        c.execute("insert into CatalogVersion(version) values (?)", (self.current_catalog_schema,))
+
+        # ‘file’ is the path of the shard relative to the catalog.
+        c.execute(
+            '''create table if not exists Deployments(
+                 uuid text primary key,
+                 name text,
+                 file text not null
+               );''')
+        c.execute("create index if not exists DeploymentsByName on Deployments(name)")
+
+    def close(self):
+        with self._shards_lock:
+            for shard in self._shards.itervalues():
+                shard.close()
+            self._shards = {}
+        self._db.close()
+
+    def _get_shard(self, uuid):
+        """Return the StateFile of the shard containing the deployment
+        with the given UUID, opening it if necessary."""
+        with self._shards_lock:
+            shard = self._shards.get(uuid)
+            if shard: return shard
+            c = self._db.cursor()
+            c.execute("select file from Deployments where uuid = ?", (uuid,))
+            row = c.fetchone()
+            if not row:
+                raise Exception("could not find deployment ‘{0}’ in state file ‘{1}’".format(uuid, self.db_file))
+            path = os.path.join(os.path.dirname(os.path.abspath(self.db_file)), row[0])
+            if not os.path.exists(path):
+                raise Exception("state file ‘{0}’ of deployment ‘{1}’ is missing".format(path, uuid))
+            shard = StateFile(path, read_only=self.read_only)
+            shard.catalog = self
+            self._shards[uuid] = shard
+            return shard
+
+    def _open_deployment(self, uuid):
+        return self._get_shard(uuid)._open_deployment(uuid)
+
+    def get_deployment_summaries(self):
+        res = []
+        for uuid in self.query_deployments():
+            res.extend(self._get_shard(uuid).get_deployment_summaries())
+        return res
 
+    def export_records(self, uuid):
+        return self._get_shard(uuid).export_records(uuid)
+
+    def _add_shard(self, uuid, name):
+        """Create an empty shard for a new deployment and register it
+        in the catalog."""
+        if not os.path.exists(self.shard_dir): os.makedirs(self.shard_dir, 0700)
+        path = os.path.join(self.shard_dir, uuid + ".nixops")
+        if os.path.exists(path):
+            raise Exception("state file ‘{0}’ already exists".format(path))
+        shard = StateFile(path)
+        shard.catalog = self
+        with self._db:
+            self._db.execute("insert into Deployments(uuid, name, file) values (?, ?, ?)",
+                             (uuid, name, os.path.relpath(path, os.path.dirname(os.path.abspath(self.db_file)))))
+        with self._shards_lock:
+            self._shards[uuid] = shard
+        return shard
+
+    def create_deployment(self, uuid=None):
+        if not uuid:
+            import uuid
+            uuid = str(uuid.uuid1())
+        return self._add_shard(uuid, None).create_deployment(uuid)
+
+    def import_records(self, records):
+        existing = set(self.query_deployments())
+        imported = []
+        for uuid, group in itertools.groupby(records, lambda record: record['uuid']):
+            if uuid in existing or uuid in imported:
+                raise Exception("state file already contains a deployment with UUID ‘{0}’".format(uuid))
+            first = next(group)
+            name = first['attrs'].get('name') if 'resource' not in first else None
+            self._add_shard(uuid, name).import_records(itertools.chain([first], group))
+            imported.append(uuid)
+        return imported
+
+    def _set_name(self, uuid, name):
+        with self._db:
+            self._db.execute("update Deployments set name = ? where uuid = ?", (name, uuid))
+
+    def _delete_shard(self, uuid):
+        shard = self._get_shard(uuid)
+        with self._db:
+            self._db.execute("delete from Deployments where uuid = ?", (uuid,))
+        with self._shards_lock:
+            self._shards.pop(uuid).close()
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(shard.db_file + suffix): os.remove(shard.db_file + suffix)
+
+
+def open_state_file(db_file, read_only=False):
+    """Open ‘db_file’, which is either an ordinary state file or the
+    catalog of a ShardedStateFile."""
+    if ShardedStateFile.is_catalog(db_file):
+        return ShardedStateFile(db_file, read_only=read_only)
+    return StateFile(db_file, read_only=read_only)
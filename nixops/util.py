@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import sys
 import time
 import json
@@ -14,14 +15,17 @@ import shutil
 import tempfile
 import subprocess
 import logging
+import threading
 import atexit
 from StringIO import StringIO
+import nixops.parallel
 
 devnull = open(os.devnull, 'rw')
 
 
 def check_wait(test, initial=10, factor=1, max_tries=60, exception=True):
-    """Call function ‘test’ periodically until it returns True or a timeout occurs."""
+    """Call function ‘test’ periodically until it returns True or a timeout occurs.
+    Raise nixops.parallel.Cancelled if the current task is cancelled while waiting."""
     wait = initial
     tries = 0
     while tries < max_tries and not test():
@@ -30,7 +34,7 @@ def check_wait(test, initial=10, factor=1, max_tries=60, exception=True):
         if tries == max_tries:
             if exception: raise Exception("operation timed out")
             return False
-        time.sleep(wait)
+        nixops.parallel.sleep(wait)
     return True
 
 
@@ -208,6 +212,59 @@ def abs_nix_path(x):
 
 undefined = object()
 
+
+class CacheStats(object):
+    """Hit/miss counters for the in-memory caches of state file
+    contents.  Each thread has its own counters, so that counting
+    doesn't make the threads wait for each other."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = []
+
+    def _get_counters(self):
+        counters = getattr(self._local, "counters", None)
+        if counters is None:
+            counters = self._local.counters = [0, 0]
+            with self._lock:
+                self._counters.append(counters)
+        return counters
+
+    def hit(self):
+        self._get_counters()[0] += 1
+
+    def miss(self):
+        self._get_counters()[1] += 1
+
+    @property
+    def hits(self):
+        with self._lock:
+            return sum(c[0] for c in self._counters)
+
+    @property
+    def misses(self):
+        with self._lock:
+            return sum(c[1] for c in self._counters)
+
+    def __str__(self):
+        return "{0} hits, {1} misses".format(self.hits, self.misses)
+
+
+# Statistics of the attribute cache of Deployment and ResourceState
+# (shown by ‘nixops --debug’).  Reads of attributes that are not in
+# the cache and reloads of the cache count as misses.
+attr_cache_stats = CacheStats()
+
+
+def db_text(value):
+    """Return ‘value’ as SQLite returns it after storing it in a text column."""
+    if isinstance(value, bool): value = int(value)
+    if isinstance(value, unicode): return value
+    if isinstance(value, str): return value.decode("utf-8")
+    return unicode(value)
+
+
 def attr_property(name, default, type=str):
     """Define a property that corresponds to a value in the NixOps state file."""
     def get(self):
@@ -349,6 +406,86 @@ def xml_expr_to_python(node):
     raise Exception("cannot convert XML output of nix-instantiate to Python: Unknown tag "+node.tag)
 
 
+class XmlExpr(object):
+    """Read-only view of a Python value, as returned by json.loads()
+    on the output of ‘nix-instantiate --json’, that behaves like the
+    ElementTree element for the same value in the output of
+    ‘nix-instantiate --xml’.  It supports the parts of the ElementTree
+    API used by resource definitions (‘find’, ‘findall’ and ‘get’
+    with paths consisting of tag names, ‘*’ and ‘[@name='...']’
+    predicates), so definitions that still take XML don't require the
+    evaluation output to be converted to XML.  Child elements are
+    created on demand, and attribute lookups by name don't scan."""
+
+    _step = re.compile(r"(\*|[a-z]+)(?:\[@name=(?:'([^']*)'|\"([^\"]*)\")\])?(?:/|$)")
+
+    def __init__(self, value, name=None):
+        self.value = value
+        self.name = name
+        if name is not None: self.tag = "attr"
+        elif isinstance(value, dict): self.tag = "attrs"
+        elif isinstance(value, list): self.tag = "list"
+        elif isinstance(value, basestring): self.tag = "string"
+        elif isinstance(value, bool): self.tag = "bool"
+        elif isinstance(value, (int, long)): self.tag = "int"
+        elif isinstance(value, float): self.tag = "float"
+        elif value is None: self.tag = "null"
+        else: raise Exception("cannot convert value of type {0} to XML".format(type(value)))
+
+    @classmethod
+    def attr(cls, name, value):
+        """Return the view of an <attr> element named ‘name’ with value ‘value’."""
+        return cls(value, name)
+
+    @property
+    def attrib(self):
+        if self.tag == "attr": return {"name": self.name}
+        if self.tag == "string": return {"value": self.value}
+        if self.tag == "bool": return {"value": "true" if self.value else "false"}
+        if self.tag in ("int", "float"): return {"value": str(self.value)}
+        return {}
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def _children(self, tag="*", name=None):
+        if self.tag == "attr":
+            children = [XmlExpr(self.value)]
+        elif self.tag == "attrs":
+            if name is not None:
+                children = [XmlExpr(self.value[name], name)] if name in self.value else []
+            else:
+                children = [XmlExpr(v, n) for n, v in sorted(self.value.iteritems())]
+        elif self.tag == "list":
+            children = [XmlExpr(v) for v in self.value]
+        else:
+            children = []
+        return [c for c in children
+                if (tag == "*" or c.tag == tag) and (name is None or c.name == name)]
+
+    def __iter__(self):
+        return iter(self._children())
+
+    def __len__(self):
+        return len(self._children())
+
+    def findall(self, path):
+        nodes = [self]
+        pos = 0
+        while pos < len(path):
+            m = self._step.match(path, pos)
+            if not m: raise Exception("unsupported XML path ‘{0}’".format(path))
+            tag, name1, name2 = m.groups()
+            name = name1 if name1 is not None else name2
+            nodes = [c for n in nodes for c in n._children(tag, name)]
+            pos = m.end()
+        return nodes
+
+    def find(self, path):
+        res = self.findall(path)
+        return res[0] if res else None
+
+
 def parse_nixos_version(s):
     """Split a NixOS version string into a list of components."""
     return s.split(".")
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import nixops.eval_cache
+
+
+class EvalCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="nixops-test")
+        self.old_env = dict(os.environ)
+        os.environ["HOME"] = self.tempdir
+        os.environ["NIX_PATH"] = ""
+        os.mkdir(self.tempdir + "/network")
+        os.mkdir(self.tempdir + "/nixops")
+        self.write("network/network.nix", "{ machine = import ./machine.nix; }")
+        self.write("network/machine.nix", "{ deployment.targetHost = \"1.2.3.4\"; }")
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.old_env)
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, contents):
+        with open(self.tempdir + "/" + name, "w") as f: f.write(contents)
+
+    def key(self, argv=["nix-instantiate"], search_path=[]):
+        return nixops.eval_cache.get_key(
+            argv, [self.tempdir + "/network/network.nix"], search_path, self.tempdir + "/nixops")
+
+    def test_key_depends_on_imports(self):
+        key = self.key()
+        self.assertEqual(self.key(), key)
+        self.assertNotEqual(self.key(argv=["nix-instantiate", "--show-trace"]), key)
+        self.write("network/machine.nix", "{ deployment.targetHost = \"1.2.3.5\"; }")
+        self.assertNotEqual(self.key(), key)
+
+    def test_uncacheable_search_path(self):
+        self.assertEqual(self.key(search_path=["nixpkgs=" + self.tempdir]), None)
+        self.assertEqual(self.key(search_path=["nixpkgs=https://example.org/nixpkgs.tar.gz"]), None)
+
+    def test_get_put(self):
+        key = self.key()
+        self.assertEqual(nixops.eval_cache.get(key), None)
+        nixops.eval_cache.put(key, "{}")
+        self.assertEqual(nixops.eval_cache.get(key), "{}")
+        self.assertEqual(nixops.eval_cache.get(key, suffix=".drv"), None)
+        nixops.eval_cache.put(key, "/nix/store/foo.drv", suffix=".drv")
+        self.assertEqual(nixops.eval_cache.get(key, suffix=".drv"), "/nix/store/foo.drv")
+        self.assertEqual(nixops.eval_cache.get(key), "{}")
@@ -1,8 +1,12 @@
+import sys
+import time
 import unittest
 
 from textwrap import dedent
 
-from nixops.nix_expr import py2nix, nix2py, nixmerge
+from nixops.nix_expr import py2nix, py2nix_attrs, py2nix_let
+from nixops.nix_expr import nix2py, nixmerge
+from nixops.nix_expr import NixMergeBuilder
 from nixops.nix_expr import RawValue, Function, Call
 
 __all__ = ['Py2NixTest', 'Nix2PyTest', 'NixMergeTest']
@@ -268,6 +272,48 @@ class Py2NixTestBase(unittest.TestCase):
         }], '[ (a b c) { cde = [ 1,2,3 (4 5 6) (7\n8\n9) ]; } ]')
 
 
+    def test_attrs(self):
+        self.assertEqual(py2nix_attrs({}), [])
+        self.assertEqual(py2nix_attrs({('a', 'b'): 1, 'c': [1, 2]}),
+                         ['  a.b = 1;', '  c = [ 1 2 ];'])
+        value = {'a': {'b': "x" * 80}, 'c': 2}
+        self.assertEqual("{\n" + "\n".join(py2nix_attrs(value)) + "\n}",
+                         py2nix(value))
+
+    def test_let(self):
+        self.assertEqual(py2nix_let({}), 'let in')
+        self.assertEqual(py2nix_let({'a': 1, 'b': RawValue("a + 1")}),
+                         'let\n  a = 1;\n  b = a + 1;\nin')
+
+    def test_large_spec(self):
+        """Benchmark rendering a physical spec of 1000 machines."""
+        spec = {}
+        for n in range(1000):
+            name = "machine-{0}".format(n)
+            spec[name] = Function("{ config, lib, pkgs, ... }", {
+                'config': {
+                    ('boot', 'kernelModules'): ['tun'],
+                    ('networking', 'extraHosts'): Call(
+                        Call(RawValue("extraHostsFor"), {}),
+                        "127.0.0.1 {0}-encrypted\n".format(name)),
+                    ('networking', 'firewall', 'trustedInterfaces'): [],
+                    ('networking', 'privateIPv4'): "10.0.{0}.{1}".format(n / 256, n % 256),
+                    ('services', 'openssh', 'knownHosts'): RawValue("knownHosts"),
+                },
+                'imports': [{
+                    ('deployment', 'ec2', 'blockDeviceMapping', '/dev/xvdf'): {
+                        'disk': "vol-{0}".format(n), 'size': 10,
+                    },
+                }],
+            })
+
+        start = time.time()
+        result = py2nix(spec)
+        elapsed = time.time() - start
+        sys.stderr.write("py2nix: {0:.2f}s ({1} bytes) ... "
+                         .format(elapsed, len(result)))
+
+
 class Nix2PyTest(unittest.TestCase):
     def test_simple(self):
         self.assertEquals(py2nix(nix2py('{\na = b;\n}'), maxwidth=0),
@@ -295,7 +341,7 @@ class NixMergeTest(unittest.TestCase):
             [7, 6, 5],
             ["abc", "def"],
             ["ghi", "abc"],
-        ], [1, 2, 3, 4, 5, 6, 7, "abc", "ghi", "def"])
+        ], [1, 2, 3, 4, 5, 6, 7, "abc", "def", "ghi"])
 
     def test_merge_dict(self):
         self.assert_merge([
@@ -317,6 +363,23 @@ class NixMergeTest(unittest.TestCase):
             'e': 'f',
         })
 
+    def test_builder(self):
+        sources = [
+            {'a': [3, 1], 'b': {'c': [1]}},
+            {'a': [2, 1], 'b': {'c': [2], 'd': 'e'}},
+            {'a': [3, 4]},
+        ]
+        builder = NixMergeBuilder()
+        self.assertEqual(builder.get({}), {})
+        for source in sources:
+            builder.add(source)
+        self.assertEqual(builder.get(), {
+            'a': [3, 1, 2, 4],
+            'b': {'c': [1, 2], 'd': 'e'},
+        })
+        self.assertEqual(sources[0], {'a': [3, 1], 'b': {'c': [1]}})
+        self.assertEqual(builder.get(), reduce(nixmerge, sources))
+
     def test_unhashable(self):
         self.assertRaises(TypeError, nixmerge, [[1]], [[2]])
         self.assertRaises(TypeError, nixmerge, [{'x': 1}], [{'y': 2}])
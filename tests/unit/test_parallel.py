@@ -0,0 +1,208 @@
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import nixops.parallel
+import nixops.statefile
+
+
+class Task(object):
+    def __init__(self, name, deps=[]):
+        self.name = name
+        self.deps = deps
+
+
+class RunDagTest(unittest.TestCase):
+    def run_dag(self, nr_workers, tasks, worker_fun=None):
+        order = []
+        def worker(t):
+            order.append(t.name)
+            if worker_fun: worker_fun(t)
+            return t.name
+        res = nixops.parallel.run_dag(nr_workers, tasks, lambda t: t.deps, worker)
+        return res, order
+
+    def test_order(self):
+        a = Task("a")
+        b = Task("b", [a])
+        c = Task("c", [a, b])
+        d = Task("d")
+        res, order = self.run_dag(4, [c, d, b, a])
+        self.assertEqual(res, ["c", "d", "b", "a"])
+        self.assertLess(order.index("a"), order.index("b"))
+        self.assertLess(order.index("b"), order.index("c"))
+
+    def test_bounded(self):
+        lock = threading.Lock()
+        running = [0, 0]
+        def worker(t):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock: running[0] -= 1
+        root = Task("root")
+        tasks = [root] + [Task("t{0}".format(n), [root]) for n in range(50)]
+        self.run_dag(5, tasks, worker)
+        self.assertEqual(running[1], 5)
+
+    def test_unbounded(self):
+        # With nr_workers=-1, all ready tasks run at the same time, so
+        # none of them finishes before the last one has started.
+        lock = threading.Lock()
+        started = [0]
+        all_started = threading.Event()
+        def worker(t):
+            with lock:
+                started[0] += 1
+                if started[0] == 50: all_started.set()
+            all_started.wait(5)
+        self.run_dag(-1, [Task("t{0}".format(n)) for n in range(50)], worker)
+        self.assertTrue(all_started.is_set())
+
+    def test_cycle(self):
+        a = Task("a")
+        b = Task("b", [a])
+        c = Task("c", [b])
+        a.deps = [c]
+        d = Task("d", [a])
+        with self.assertRaises(nixops.parallel.DependencyCycle) as cm:
+            self.run_dag(2, [d, a, b, c])
+        msg = str(cm.exception)
+        self.assertTrue(msg.startswith("dependency cycle: "))
+        self.assertEqual(msg.count("->"), 3)
+
+    def test_skip_dependents_of_failed(self):
+        def worker(t):
+            if t.name == "a": raise Exception("failed")
+        a = Task("a")
+        b = Task("b", [a])
+        c = Task("c", [b])
+        d = Task("d")
+        order = []
+        try:
+            self.run_dag(2, [a, b, c, d], lambda t: order.append(t.name) or worker(t))
+        except Exception as e:
+            self.assertEqual(str(e), "failed")
+        else:
+            self.fail("exception not raised")
+        self.assertEqual(sorted(order), ["a", "d"])
+
+    def test_critical_path_first(self):
+        a = Task("a")
+        b = Task("b", [a])
+        c = Task("c", [b])
+        slow = Task("slow")
+        fast = Task("fast")
+        durations = {"slow": 10, "fast": 1}
+        res, order = self.run_dag(1, [slow, a, b, c, fast])
+        self.assertEqual(order[0], "a")
+        order = []
+        nixops.parallel.run_dag(1, [slow, a, b, c, fast], lambda t: t.deps,
+                                lambda t: order.append(t.name), lambda t: durations.get(t.name, 1))
+        self.assertEqual(order, ["slow", "a", "b", "c", "fast"])
+
+    def test_external_dependencies(self):
+        a = Task("a", [Task("elsewhere")])
+        self.assertEqual(self.run_dag(1, [a])[0], ["a"])
+
+
+class ExecutorTest(unittest.TestCase):
+    def test_run_tasks(self):
+        self.assertEqual(sorted(nixops.parallel.run_tasks(3, range(10), lambda n: n * n)),
+                         [n * n for n in range(10)])
+        self.assertEqual(nixops.parallel.run_tasks(-1, [], lambda n: n), [])
+
+    def test_run_tasks_exceptions(self):
+        def worker(n):
+            if n % 2: raise Exception("odd")
+        self.assertRaises(nixops.parallel.MultipleExceptions, nixops.parallel.run_tasks, 2, range(4), worker)
+
+    def test_threads_reused(self):
+        executor = nixops.parallel.Executor()
+        threads = set()
+        def worker(n):
+            threads.add(threading.current_thread())
+            time.sleep(0.01)
+        for n in range(3):
+            list(executor.imap_unordered(worker, range(4), 4))
+        self.assertEqual(len(threads), 4)
+
+    def test_streaming(self):
+        done = threading.Event()
+        def worker(n):
+            if n == 1: done.wait(5)
+            return n
+        results = nixops.parallel.executor.imap_unordered(worker, [0, 1], 2)
+        self.assertEqual(next(results), (0, 0))
+        done.set()
+        self.assertEqual(list(results), [(1, 1)])
+
+    def test_fail_fast(self):
+        started = []
+        def worker(n):
+            started.append(n)
+            if n == 0: raise Exception("failed")
+            nixops.parallel.sleep(60)
+        start = time.time()
+        results = nixops.parallel.executor.imap_unordered(worker, range(10), 2, fail_fast=True)
+        with self.assertRaises(Exception) as cm:
+            list(results)
+        self.assertEqual(str(cm.exception), "failed")
+        self.assertLess(time.time() - start, 5)
+        self.assertLess(len(started), 10)
+
+    def test_cancel(self):
+        token = nixops.parallel.CancellationToken()
+        def worker(n):
+            if n == 0: token.cancel()
+            else: nixops.parallel.sleep(60)
+        results = nixops.parallel.executor.imap_unordered(worker, range(4), 4, token=token)
+        self.assertRaises(nixops.parallel.Cancelled, list, results)
+
+    def test_progress(self):
+        progress = []
+        list(nixops.parallel.executor.imap_unordered(
+            lambda n: n, range(3), 1, progress=lambda t, done, total: progress.append((done, total))))
+        self.assertEqual(progress, [(1, 3), (2, 3), (3, 3)])
+
+
+class PartialSelectionTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="nixops-test")
+        self.sf = nixops.statefile.StateFile(self.tempdir + "/test.nixops")
+        self.depl = self.sf.create_deployment()
+        with self.depl._db:
+            self.depl._create_resource("machine", "ec2")
+            self.depl._create_resource("key", "ec2-keypair")
+
+    def tearDown(self):
+        self.sf.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_unselected_resources(self):
+        # With --include, only the selected resources are evaluated.
+        class Definition(object):
+            keypair_name = "key"
+        self.depl.definitions = {"key": Definition()}
+        include, exclude = ["key"], []
+        order = []
+        nixops.parallel.run_dag(
+            4, self.depl.active_resources.values(),
+            lambda r: self.depl._get_create_dependencies(r, include, exclude),
+            lambda r: order.append(r.name))
+        self.assertEqual(sorted(order), ["key", "machine"])
+
+    def test_duration_estimate(self):
+        # Resources that already exist take no time to "create".
+        self.depl.resource_durations = {"create": {"ec2": 60.0, "ec2-keypair": 2.0}}
+        key = self.depl.resources["key"]
+        key.creation_time = 1
+        key.state = key.UP
+        estimate = self.depl._get_duration_estimate("create", [], [])
+        self.assertEqual(estimate(self.depl.resources["machine"]), 60.0)
+        self.assertEqual(estimate(key), 0)
+        estimate = self.depl._get_duration_estimate("destroy", [], [])
+        self.assertEqual(estimate(key), 1.0)
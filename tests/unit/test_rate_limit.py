@@ -0,0 +1,83 @@
+import time
+import threading
+import unittest
+
+import nixops.rate_limit
+
+
+class Counter(object):
+    def __init__(self):
+        self.calls = 0
+        self.name = "counter"
+
+    def call(self):
+        self.calls += 1
+        return self.calls
+
+
+class RateLimitTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        bucket = nixops.rate_limit.TokenBucket(100.0, 5)
+        start = time.time()
+        for n in range(5): bucket.acquire()
+        self.assertLess(time.time() - start, 0.05)
+        for n in range(10): bucket.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.09)
+
+    def test_throttled(self):
+        bucket = nixops.rate_limit.TokenBucket(100.0, 50)
+        bucket.throttled()
+        start = time.time()
+        for n in range(5): bucket.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.04)
+
+    def test_throttled_last_bucket(self):
+        used = nixops.rate_limit.TokenBucket(100.0, 50)
+        other = nixops.rate_limit.TokenBucket(100.0, 50)
+        used.acquire()
+        nixops.rate_limit.throttled()
+        self.assertLessEqual(used._tokens, 0)
+        self.assertGreater(other._tokens, 0)
+
+    def test_concurrency(self):
+        bucket = nixops.rate_limit.TokenBucket(1000.0, 100, 2)
+        lock = threading.Lock()
+        running = [0, 0]
+        def fun():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+        threads = [threading.Thread(target=bucket.call, args=(fun,)) for n in range(6)]
+        for thr in threads: thr.start()
+        for thr in threads: thr.join()
+        self.assertEqual(running[1], 2)
+
+    def test_shared_buckets(self):
+        get = nixops.rate_limit.get_bucket
+        self.assertIs(get("ec2", "us-east-1", "key"), get("ec2", "us-east-1", "key"))
+        self.assertIsNot(get("ec2", "us-east-1", "key"), get("ec2", "eu-west-1", "key"))
+        self.assertIsNot(get("ec2", "us-east-1", "key"), get("ec2", "us-east-1", "other"))
+
+    def test_parse_limits(self):
+        self.assertEqual(nixops.rate_limit._parse_limits("ec2=20:100:8, gce=5"),
+                         {"ec2": (20.0, 100, 8), "gce": (5.0, 5, None)})
+        self.assertRaises(Exception, nixops.rate_limit._parse_limits, "ec2")
+        self.assertRaises(Exception, nixops.rate_limit._parse_limits, "ec2=0")
+
+    def test_proxy(self):
+        bucket = nixops.rate_limit.TokenBucket(1000.0, 1)
+        counter = Counter()
+        proxy = nixops.rate_limit.RateLimited(counter, bucket)
+        self.assertEqual(proxy.name, "counter")
+        self.assertEqual(proxy.call(), 1)
+        self.assertEqual(proxy.call(), 2)
+        self.assertLessEqual(bucket._tokens, 0)
+
+    def test_limit_method(self):
+        bucket = nixops.rate_limit.TokenBucket(1000.0, 1)
+        counter = nixops.rate_limit.limit_method(Counter(), "call", bucket)
+        self.assertEqual(counter.call(), 1)
+        self.assertLessEqual(bucket._tokens, 0)
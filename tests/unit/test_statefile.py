@@ -0,0 +1,204 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import nixops.deployment
+import nixops.statefile
+
+
+class StateFileTestBase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="nixops-test")
+        self.sf = nixops.statefile.StateFile(self.tempdir + "/test.nixops")
+
+    def tearDown(self):
+        self.sf.close()
+        shutil.rmtree(self.tempdir)
+
+    def run_threads(self, nr_threads, fun):
+        threads = [threading.Thread(target=fun) for n in range(nr_threads)]
+        for thr in threads: thr.start()
+        for thr in threads: thr.join()
+
+
+class ConnectionPoolTest(StateFileTestBase):
+    def test_reader_per_thread(self):
+        db = self.sf._db
+        readers = []
+        def fun():
+            db.execute("select 1")
+            readers.append(db._get_connection())
+        self.run_threads(10, fun)
+        self.assertEqual(len(set([id(r) for r in readers])), 10)
+        self.assertNotIn(db.writer, readers)
+
+    def test_dead_readers_closed(self):
+        db = self.sf._db
+        self.run_threads(5, lambda: db.execute("select 1"))
+        self.run_threads(1, lambda: db.execute("select 1"))
+        self.assertEqual(len(db._readers), 1)
+
+    def test_nested_writes(self):
+        db = self.sf._db
+        with db:
+            with db:
+                self.assertIs(db._get_connection(), db.writer)
+                db.execute("insert into Deployments(uuid) values ('foo')")
+            self.assertIs(db._get_connection(), db.writer)
+        self.assertIsNot(db._get_connection(), db.writer)
+        self.assertEqual(self.sf.query_deployments(), ["foo"])
+
+    def test_readers_see_writes(self):
+        depl = self.sf.create_deployment()
+        depl.name = "foo"
+        found = []
+        def fun():
+            found.append(self.sf.open_deployment("foo").uuid)
+        self.run_threads(5, fun)
+        self.assertEqual(found, [depl.uuid] * 5)
+
+    def test_reads_dont_wait_for_writer(self):
+        db = self.sf._db
+        db.execute("select 1")
+        in_transaction = threading.Event()
+        done = threading.Event()
+        def write():
+            with nixops.statefile.Transaction(db):
+                db.execute("insert into Deployments(uuid) values ('foo')")
+                in_transaction.set()
+                done.wait(10)
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            in_transaction.wait(10)
+            found = []
+            self.run_threads(5, lambda: found.append(self.sf.query_deployments()))
+            self.assertEqual(found, [[]] * 5)
+        finally:
+            done.set()
+            writer.join()
+        self.assertEqual(self.sf.query_deployments(), ["foo"])
+
+    def test_read_throughput(self):
+        """Benchmark reads from 200 threads while another thread holds
+        a write transaction, through the per-thread readers and through
+        the single writer connection.  Only the latter have to wait for
+        the writer."""
+        for n in range(100):
+            self.sf.create_deployment().name = "depl-{0}".format(n)
+        db = self.sf._db
+        nr_threads, nr_reads = 200, 20
+
+        def read_pooled():
+            for n in range(nr_reads):
+                db.execute("select uuid from Deployments where name = ?", ("depl-42",)).fetchall()
+
+        def read_serialized():
+            for n in range(nr_reads):
+                with db:
+                    db.execute("select uuid from Deployments where name = ?", ("depl-42",)).fetchall()
+
+        elapsed = {}
+        for fun in [read_pooled, read_serialized]:
+            in_transaction = threading.Event()
+            def write():
+                with nixops.statefile.Transaction(db):
+                    db.execute("insert or replace into DeploymentAttrs(deployment, name, value) select uuid, 'foo', 'x' from Deployments")
+                    in_transaction.set()
+                    time.sleep(0.5)
+            writer = threading.Thread(target=write)
+            writer.start()
+            in_transaction.wait(10)
+            start = time.time()
+            self.run_threads(nr_threads, fun)
+            elapsed[fun] = time.time() - start
+            writer.join()
+        self.assertGreaterEqual(elapsed[read_serialized], 0.4)
+        self.assertLess(elapsed[read_pooled] * 2, elapsed[read_serialized])
+
+
+class AttrJournalTest(StateFileTestBase):
+    def test_rollback_keeps_journal(self):
+        depl = self.sf.create_deployment()
+        with depl._db:
+            m = depl._create_resource("m", "none")
+        with nixops.deployment.AttrJournal(depl, [m]):
+            m.index = 3
+            # A rollback elsewhere makes the deployment reload its
+            # attributes from the state file.
+            try:
+                with nixops.statefile.Transaction(depl._db):
+                    raise Exception("rolled back")
+            except Exception:
+                pass
+            self.assertEqual(m.index, 3)
+        self.assertEqual(self.sf.open_deployment(depl.uuid).resources["m"].index, 3)
+
+
+class ExportImportTest(StateFileTestBase):
+    def test_roundtrip(self):
+        depl = self.sf.create_deployment()
+        depl.name = "foo"
+        with self.sf._db:
+            c = self.sf._db.cursor()
+            c.execute("insert into Resources(deployment, name, type) values (?, 'm', 'none')", (depl.uuid,))
+            c.execute("insert into ResourceAttrs(machine, name, value) values (?, 'state', '3')", (c.lastrowid,))
+            c.execute("insert into Resources(deployment, name, type) values (?, 'n', 'none')", (depl.uuid,))
+        records = list(self.sf.export_records(depl.uuid))
+        self.assertEqual(len(records), 3)
+
+        other = nixops.statefile.StateFile(self.tempdir + "/other.nixops")
+        try:
+            self.assertEqual(other.import_records(records), [depl.uuid])
+            self.assertEqual(list(other.export_records(depl.uuid)), records)
+            self.assertEqual(other.open_deployment("foo").uuid, depl.uuid)
+        finally:
+            other.close()
+
+    def test_import_existing(self):
+        depl = self.sf.create_deployment()
+        records = list(self.sf.export_records(depl.uuid))
+        self.assertRaises(Exception, self.sf.import_records, records)
+        self.assertEqual(self.sf.query_deployments(), [depl.uuid])
+
+
+class ShardedStateFileTest(StateFileTestBase):
+    def setUp(self):
+        StateFileTestBase.setUp(self)
+        self.catalog = nixops.statefile.ShardedStateFile(self.tempdir + "/sharded.nixops")
+
+    def tearDown(self):
+        self.catalog.close()
+        StateFileTestBase.tearDown(self)
+
+    def test_open_state_file(self):
+        for sf, cls in [(self.sf, nixops.statefile.StateFile), (self.catalog, nixops.statefile.ShardedStateFile)]:
+            opened = nixops.statefile.open_state_file(sf.db_file)
+            self.assertIs(type(opened), cls)
+            opened.close()
+
+    def test_shard_per_deployment(self):
+        foo = self.catalog.create_deployment()
+        foo.name = "foo"
+        bar = self.catalog.create_deployment()
+        self.assertNotEqual(foo._db.db_file, bar._db.db_file)
+        self.assertEqual(self.catalog.open_deployment("foo").uuid, foo.uuid)
+        foo.name = "baz"
+        self.assertEqual(self.catalog.open_deployment("baz").uuid, foo.uuid)
+        bar.delete()
+        self.assertEqual(self.catalog.query_deployments(), [foo.uuid])
+        self.assertFalse(os.path.exists(bar._db.db_file))
+
+    def test_migrate(self):
+        depl = self.sf.create_deployment()
+        depl.name = "foo"
+        with self.sf._db:
+            self.sf._db.execute("insert into Resources(deployment, name, type) values (?, 'm', 'none')", (depl.uuid,))
+        records = list(self.sf.export_records(depl.uuid))
+        self.assertEqual(self.catalog.import_records(records), [depl.uuid])
+        self.assertEqual(list(self.catalog.export_records(depl.uuid)), records)
+        self.assertEqual(self.catalog.open_deployment("foo").resources.keys(), ["m"])
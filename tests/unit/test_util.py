@@ -0,0 +1,127 @@
+import threading
+import unittest
+
+from xml.etree import ElementTree
+
+from nixops.util import attr_property, undefined, XmlExpr, xml_expr_to_python, CacheStats
+
+
+class Attrs(object):
+    mapping = attr_property("mapping", {}, 'json')
+
+    def __init__(self):
+        self.attrs = {}
+
+    def _get_attr(self, name, default):
+        return self.attrs.get(name, undefined)
+
+    def _set_attr(self, name, value):
+        self.attrs[name] = value
+
+    def _del_attr(self, name):
+        self.attrs.pop(name, None)
+
+
+class JsonAttrTest(unittest.TestCase):
+    def setUp(self):
+        self.obj = Attrs()
+        self.value = {"a": {"b": [1, {"c": 2}]}, "d": 3}
+        self.obj.mapping = self.value
+
+    def test_nested_modification(self):
+        x = self.obj.mapping
+        x["a"]["b"][1]["c"] = 5
+        x["a"]["b"].append(6)
+        x.setdefault("e", []).append(7)
+        self.assertEqual(x, {"a": {"b": [1, {"c": 5}, 6]}, "d": 3, "e": [7]})
+        self.assertEqual(self.obj.mapping, self.value)
+
+    def test_iteration(self):
+        for k, v in self.obj.mapping.iteritems():
+            if k == "a": v["b"].pop()
+        for v in self.obj.mapping.values():
+            if isinstance(v, dict):
+                for e in v["b"]:
+                    if isinstance(e, dict): e.clear()
+        self.assertEqual(self.obj.mapping, self.value)
+
+    def test_copies(self):
+        x = dict(self.obj.mapping)
+        x["a"]["b"].append(4)
+        y = {}
+        y.update(self.obj.mapping)
+        y["a"]["e"] = 5
+        for k, v in self.obj.mapping.viewitems():
+            if k == "a": v.clear()
+        self.assertEqual(self.obj.mapping, self.value)
+
+    def test_write_invalidates(self):
+        x = self.obj.mapping
+        x["d"] = 4
+        self.obj.mapping = x
+        self.assertEqual(self.obj.mapping["d"], 4)
+        self.obj.mapping = {}
+        self.assertEqual(self.obj.mapping, {})
+
+
+class CacheStatsTest(unittest.TestCase):
+    def test_threads(self):
+        stats = CacheStats()
+        def fun():
+            for n in range(100): stats.hit()
+            stats.miss()
+        threads = [threading.Thread(target=fun) for n in range(10)]
+        for thr in threads: thr.start()
+        for thr in threads: thr.join()
+        self.assertEqual((stats.hits, stats.misses), (1000, 10))
+        self.assertEqual(str(stats), "1000 hits, 10 misses")
+
+
+def to_xml(value):
+    """Render value the way nix-instantiate --xml does."""
+    if isinstance(value, dict):
+        return "<attrs>" + "".join('<attr name="{0}">{1}</attr>'.format(n, to_xml(v))
+                                   for n, v in sorted(value.items())) + "</attrs>"
+    if isinstance(value, list):
+        return "<list>" + "".join(to_xml(v) for v in value) + "</list>"
+    if isinstance(value, bool):
+        return '<bool value="{0}" />'.format("true" if value else "false")
+    if isinstance(value, int):
+        return '<int value="{0}" />'.format(value)
+    if value is None:
+        return "<null />"
+    return '<string value="{0}" />'.format(value)
+
+
+class XmlExprTest(unittest.TestCase):
+    value = {
+        "targetPort": 22,
+        "owners": ["alice", "bob"],
+        "publicIPv4": None,
+        "ec2": {"ebsOptimized": False, "blockDeviceMapping": {"/dev/xvdb": {"size": 10}}},
+        "keys": {"a": {"text": "secret", "user": "root"}},
+    }
+
+    paths = [
+        "*",
+        "attrs/attr",
+        "attrs/attr[@name='targetPort']/int",
+        "attrs/attr[@name='targetPort']/string",
+        "attrs/attr[@name='owners']/list/string",
+        "attrs/attr[@name='publicIPv4']/string",
+        "attrs/attr[@name='ec2']/attrs/attr[@name='ebsOptimized']/bool",
+        "attrs/attr[@name='ec2']/attrs/attr[@name='blockDeviceMapping']/attrs/attr",
+        "attrs/attr[@name='keys']/attrs/attr/attrs/attr[@name='text']/string",
+        "attrs/attr[@name='missing']",
+    ]
+
+    def describe(self, elems):
+        return [(e.tag, e.get("name"), e.get("value"), len(e)) for e in elems]
+
+    def test_same_as_xml(self):
+        expr = XmlExpr.attr("machine", self.value)
+        tree = ElementTree.fromstring('<attr name="machine">' + to_xml(self.value) + "</attr>")
+        for path in self.paths:
+            self.assertEqual(self.describe(expr.findall(path)), self.describe(tree.findall(path)), path)
+        self.assertEqual(expr.find(self.paths[-1]), None)
+        self.assertEqual(xml_expr_to_python(expr.find("*")), self.value)